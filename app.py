@@ -1,18 +1,65 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-from pymongo import Connection
+import os
+import time
+importStart = time.time()
+from datetime import datetime
 
-from wmata import WMATA
-from nextbus import NextBus
-from connexionz import Connexionz
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, abort, g
+from werkzeug.local import LocalProxy
+
+import metrics
+
+from poller import getHealth
+from push import PredictionChannel
+from cache import FragmentCache
+from services import PerProcess, Services
+from upstream import connectionStats
+from workers import WorkerPool
+from jsonapi import cachedJSON, secondsUntil, staleAge, toJSON
+from spatial import isFinite
 
 app = Flask(__name__)
 app.config.from_envvar('CTI_SETTINGS')
-connection = Connection()
-db = connection[app.config['DB_NAME']]
-
-wmata = WMATA(app.config['WMATA_KEY'], db)
-circulator = NextBus("dc-circulator", db, 'nextbus')
-art = Connexionz("http://realtime.commuterpage.com", "ART", db, 'art')
+metrics.instrumentMongo()
+
+services = PerProcess(lambda: Services(app.config))
+db = LocalProxy(lambda: services.get().db)
+wmata = LocalProxy(lambda: services.get().wmata)
+circulator = LocalProxy(lambda: services.get().circulator)
+art = LocalProxy(lambda: services.get().art)
+nearbyIndex = LocalProxy(lambda: services.get().nearbyIndex)
+
+fanoutPools = PerProcess(lambda: WorkerPool(app.config.get('NEARBY_WORKERS', 16)))
+fanoutPool = LocalProxy(fanoutPools.get)
+
+pageCache = FragmentCache(maxBytes=app.config.get('PAGE_CACHE_BYTES', 8 * 1024 * 1024))
+
+def cachedPage(version, render):
+    if version is None:
+        return render()
+    key = (request.endpoint, tuple(sorted(request.view_args.items())))
+    return pageCache.get(key, version, render)
+
+@app.before_request
+def startViewTimer():
+    g.viewStart = time.time()
+
+firstRequestSeconds = {}
+
+@app.after_request
+def recordViewTime(response):
+    if request.endpoint is not None:
+        metrics.viewSeconds.observe(time.time() - g.viewStart, (request.endpoint, str(response.status_code)))
+        g.viewRecorded = True
+    if os.getpid() not in firstRequestSeconds:
+        firstRequestSeconds[os.getpid()] = time.time() - g.viewStart
+        app.logger.info("Process %d served its first request in %.3fs (services built in %.3fs)",
+                        os.getpid(), firstRequestSeconds[os.getpid()], services.seconds or 0)
+    return response
+
+@app.teardown_request
+def recordFailedViewTime(exception):
+    if exception is not None and request.endpoint is not None and not getattr(g, 'viewRecorded', False):
+        metrics.viewSeconds.observe(time.time() - g.viewStart, (request.endpoint, '500'))
 
 @app.route("/")
 def index():
@@ -41,8 +88,14 @@ def wmata_stop_lookup():
 @app.route("/wmata/bus/stop/<stopID>")
 def wmata_stop(stopID):
     stop = wmata.getStop(stopID)
-    predictions = wmata.getBusPredictions(stopID)
-    return render_template("wmata/stop.html", stop=stop, predictions=predictions)
+    (version, rows) = busStopChannel.current(stopID)
+    return render_template("wmata/stop.html", stop=stop, rows=rows, version=version,
+                           age=staleAge(*wmata.getBusPredictionsTimes(stopID)),
+                           updates=url_for('wmata_stop_updates', stopID=stopID), pollInterval=POLL_INTERVAL_SECONDS)
+
+@app.route("/wmata/bus/stop/<stopID>/updates")
+def wmata_stop_updates(stopID):
+    return jsonify(busStopChannel.wait(stopID, request.args.get('since'), LONG_POLL_SECONDS))
 
 @app.route("/wmata/bus/stops/geo")
 def wmata_stops_geo():
@@ -57,8 +110,8 @@ def wmata_stops_geo():
 
 @app.route("/wmata/stations")
 def wmata_stations():
-    stations = wmata.getStations()
-    return render_template("wmata/stations.html", stations=stations)
+    return cachedPage(wmata.stationsGeneration.current(),
+                      lambda: render_template("wmata/stations.html", stations=wmata.getStations()))
 
 @app.route("/wmata/stations/geo")
 def wmata_stations_geo():
@@ -73,46 +126,84 @@ def wmata_stations_geo():
 
 @app.route("/wmata/station/<path:rtuCodes>")
 def wmata_station(rtuCodes):
-    rtuCodes = rtuCodes.split('/')
-    predictions = wmata.getRailPredictions(rtuCodes)
-    predictionGroups = sorted(predictions.keys(), key=lambda x: getTrack(x[0], x[1]))
-    return render_template("wmata/station.html", predictions=predictions, predictionGroups=predictionGroups,
-                           getTrack=getTrack, getTitle=getTitle)
-
-def getTrack(rtu, track):
-    return rtu[0] + str(track)
-
-def getTitle(track):
-    return {'A1': 'To Glenmont via Downtown',
-            'A2': 'To Shady Grove',
-            'B1': 'To Glenmont',
-            'B2': 'To Shady Grove via Downtown',
-            'C1': 'To Maryland via Downtown',
-            'C2': 'To Virginia',
-            'D1': 'To Maryland',
-            'D2': 'To Virginia via Downtown',
-            'E1': 'To Greenbelt',
-            'E2': 'To Maryland and Virginia via Downtown',
-            'F1': 'To Greenbelt via Downtown',
-            'F2': 'To Maryland and Virginia',
-            'G1': 'To Largo',
-            'G2': 'To Virginia via Downtown',
-            'J1': 'To Maryland via Downtown',
-            'J2': 'To Franconia-Springfield',
-            'K1': 'To Maryland via Downtown',
-            'K2': 'To Vienna',
-            }[track]
+    (version, rows) = stationChannel.current(rtuCodes)
+    return render_template("wmata/station.html", rows=rows, version=version,
+                           updates=url_for('wmata_station_updates', rtuCodes=rtuCodes),
+                           pollInterval=POLL_INTERVAL_SECONDS)
+
+@app.route("/wmata/station/<path:rtuCodes>/updates")
+def wmata_station_updates(rtuCodes):
+    return jsonify(stationChannel.wait(rtuCodes, request.args.get('since'), LONG_POLL_SECONDS))
+
+# Only hold update requests open (LONG_POLL_SECONDS) under threaded or async workers.
+LONG_POLL_SECONDS = app.config.get('LONG_POLL_SECONDS', 0)
+POLL_INTERVAL_SECONDS = app.config.get('POLL_INTERVAL_SECONDS', 15)
+
+def stationRows(rtuCodes):
+    rows = []
+    for group in wmata.getRailPredictions(rtuCodes.split('/')):
+        groupID = '%s-%s' % (group['locationCode'], group['track'])
+        rows.append({'id': groupID, 'divider': group['title']})
+        for (index, prediction) in enumerate(group['trains']):
+            rows.append({'id': '%s-%d' % (groupID, index),
+                         'line': prediction['line'],
+                         'dest': prediction['dest'],
+                         'car': prediction['car'],
+                         'min': prediction['min']})
+    return rows
+
+def stationVersions(keys):
+    board = wmata.getRailBoard()
+    version = str(board.generation) if board is not None else ''
+    return dict((key, version) for key in keys)
+
+def busStopRows(stopID):
+    return [{'id': str(index),
+             'route': prediction['route'],
+             'direction': prediction['direction'],
+             'minutes': prediction['minutes']}
+            for (index, prediction) in enumerate(wmata.getBusPredictions(stopID))]
+
+emptyStopChecks = {}
+
+def busStopVersions(stopIDs):
+    for (stopID, checked) in emptyStopChecks.items():
+        if time.time() - checked > 60:
+            emptyStopChecks.pop(stopID, None)
+    expirations = dict((stopID, wmata.getBusPredictionsExpiration(stopID)) for stopID in stopIDs)
+    now = datetime.utcnow()
+    expired = [stopID for (stopID, expiration) in expirations.items()
+               if (expiration is None and time.time() - emptyStopChecks.get(stopID, 0) > 60) or
+                  (expiration is not None and expiration < now)]
+    for stopID in expired:
+        emptyStopChecks[stopID] = time.time()
+    fanoutPool.mapUntil(lambda stopID: list(wmata.getBusPredictions(stopID)), expired, 10)
+    for stopID in expired:
+        expirations[stopID] = wmata.getBusPredictionsExpiration(stopID)
+        if expirations[stopID] is not None:
+            emptyStopChecks.pop(stopID, None)
+    return dict((stopID, toJSON(expiration) if expiration is not None else '')
+                for (stopID, expiration) in expirations.items())
+
+stationChannel = PredictionChannel(stationVersions, stationRows,
+                                   interval=app.config.get('PUSH_CHECK_INTERVAL', 1.0))
+busStopChannel = PredictionChannel(busStopVersions, busStopRows,
+                                   interval=app.config.get('PUSH_CHECK_INTERVAL', 1.0))
 
 @app.route("/wmata/incidents/rail")
 def wmata_rail_incidents():
-    incidents = wmata.getRailIncidents()
-    return render_template("wmata/incidents.html", incidents=incidents)
+    snapshot = wmata.getRailIncidentsSnapshot()
+    return cachedPage(snapshot['generation'] if snapshot is not None else None,
+                      lambda: render_template("wmata/incidents.html",
+                                              incidents=wmata.getRailIncidents(snapshot)))
 
 @app.route("/wmata/incidents/eles")
 def wmata_eles_incidents():
-    incidentStations = wmata.getELESIncidentStations()
-    return render_template("wmata/eles/stations.html", incidentStations=incidentStations,
-                           incidentCountByStation=wmata.getELESIncidentCountByStation)
+    snapshot = wmata.getELESIncidentsSnapshot()
+    version = (snapshot['generation'], wmata.stationsGeneration.current()) if snapshot is not None else None
+    return cachedPage(version,
+                      lambda: render_template("wmata/eles/stations.html",
+                                              incidentStations=wmata.getELESStationSummary(snapshot)))
 
 @app.route("/wmata/incidents/eles/<path:rtuCodes>")
 def wmata_eles_incidents_station(rtuCodes):
@@ -122,37 +213,31 @@ def wmata_eles_incidents_station(rtuCodes):
 
 @app.route("/wmata/incidents/eles/json")
 def wmata_eles_incidents_json():
-    stationList = []
-    
-    incidentStations = wmata.getELESIncidentStations()
-
-    for station in incidentStations:
-        stationList.append((station['name'], wmata.getELESIncidentCountByStation(station['rtus'])))
+    incidentStations = wmata.getELESStationSummary()
 
+    stationList = [(station['name'], station['count']) for station in incidentStations]
     stationList.sort(key=lambda x: x[1], reverse=True)
 
     failCount = len(stationList)
     failRate = "%.2f%%" % (100 * (failCount / 86.0))
 
-    return jsonify(stationList=stationList, failRate=failRate, failCount=failCount)
+    return jsonify(stationList=stationList, failRate=failRate, failCount=failCount,
+                   stations=incidentStations)
 
 @app.route("/circulator/routes")
 def circulator_routes():
-    routes = circulator.getRoutes()
-    return render_template("circulator/routes.html", routes=routes)
+    return cachedPage(circulator.routesGeneration.current(),
+                      lambda: render_template("circulator/routes.html", routes=circulator.getRoutes()))
 
 @app.route("/circulator/route/<routeTag>")
 def circulator_route(routeTag):
-    route = circulator.getRoute(routeTag)
-    return render_template("circulator/route.html", route=route)
+    return cachedPage(circulator.routesGeneration.current(),
+                      lambda: render_template("circulator/route.html", route=circulator.getRoute(routeTag)))
 
 @app.route("/circulator/route/<routeTag>/<directionTag>/stops")
 def circulator_stops(routeTag, directionTag):
-    route = circulator.getRoute(routeTag)
-    direction = route['directions'][directionTag]
-    stopTags = direction['stops']
-    stops = [circulator.getStopByTag(stopTag) for stopTag in stopTags]
-    return render_template("circulator/stops.html", route=route, stops=stops)
+    routeStops = found(circulator.getRouteStops(routeTag, directionTag))
+    return render_template("circulator/stops.html", route=routeStops, stops=routeStops['stops'])
 
 @app.route("/circulator/stops/geo")
 def circulator_stops_geo():
@@ -168,14 +253,16 @@ def circulator_stops_geo():
 @app.route("/circulator/stop/<int:stopID>")
 def circulator_stop_id(stopID):
     stop = circulator.getStopByID(stopID)
-    predictions = circulator.getPredictionsByID(stopID)
-    return render_template("circulator/stop.html", stop=stop, predictions=predictions)
+    predictions = list(circulator.getPredictionsByID(stopID))
+    return render_template("circulator/stop.html", stop=stop, predictions=predictions,
+                           age=listAge(predictions))
 
 @app.route("/circulator/stop/<stopTag>/<routeTag>")
 def circulator_stop_tag(stopTag, routeTag):
     stop = circulator.getStopByTag(stopTag)
-    predictions = circulator.getPredictionsByTag(stopTag, routeTag)
-    return render_template("circulator/stop.html", stop=stop, predictions=predictions)
+    predictions = list(circulator.getPredictionsByTag(stopTag, routeTag))
+    return render_template("circulator/stop.html", stop=stop, predictions=predictions,
+                           age=listAge(predictions))
 
 @app.route("/art/")
 def art_index():
@@ -183,21 +270,21 @@ def art_index():
 
 @app.route("/art/routes/")
 def art_routes():
-    routes = art.getRoutes()
-    return render_template("art/routes.html", routes=routes)
+    return cachedPage(art.routesGeneration.current(),
+                      lambda: render_template("art/routes.html", routes=art.getRoutes()))
 
 @app.route("/art/route/<routeNumber>")
 def art_route(routeNumber):
-    route = art.getRoute(routeNumber)
-    patterns = route['patterns'].values()
-    return render_template("art/route.html", routeNumber=routeNumber, patterns=patterns)
+    def render():
+        route = art.getRoute(routeNumber)
+        patterns = route['patterns'].values()
+        return render_template("art/route.html", routeNumber=routeNumber, patterns=patterns)
+    return cachedPage(art.routesGeneration.current(), render)
 
 @app.route("/art/route/<routeNumber>/<routeTag>")
 def art_stops(routeNumber, routeTag):
-    route = art.getRoute(routeNumber)
-    pattern = route['patterns'][routeTag]
-    stops = [art.getStop(stopTag) for stopTag in pattern['platforms']]
-    return render_template("art/stops.html", stops=stops)
+    routeStops = found(art.getRouteStops(routeNumber, routeTag))
+    return render_template("art/stops.html", stops=routeStops['stops'])
 
 @app.route("/art/stops/geo")
 def art_stops_geo():
@@ -213,15 +300,266 @@ def art_stops_geo():
 @app.route("/art/stop")
 def art_stop_lookup():
     stopid = request.args['stopid']
-    return redirect(url_for('art_stop', stopTag=art.getStopTag(stopid)), code=303)
+    return redirect(url_for('art_stop', stopTag=found(art.getStopTag(stopid))), code=303)
 
 @app.route("/art/stop/<stopTag>")
 def art_stop(stopTag):
     stop = art.getStop(stopTag)
     predictions = art.getPredictions(stopTag)
     return render_template("art/stop.html", stop=stop,
-                           predictions=predictions['predictions'])
+                           predictions=predictions['predictions'],
+                           age=staleAge(predictions['expires'], predictions.get('fetched')))
     
 
+def floatArg(name, default=None):
+    try:
+        value = float(request.args.get(name, default))
+    except (TypeError, ValueError):
+        abort(400, "%s must be a number" % name)
+    if not isFinite(value):
+        abort(400, "%s must be finite" % name)
+    return value
+
+@app.route("/nearby")
+def nearby():
+    if 'latitude' in request.args and 'longitude' in request.args:
+        latitude = floatArg('latitude')
+        longitude = floatArg('longitude')
+        radius = floatArg('radius', 0.5)
+
+        places = nearbyIndex.near(longitude, latitude, radius, limit=100)
+        return render_template("nearby.html", places=places)
+    else:
+        return render_template("geo.html", destination=url_for('nearby'))
+
+def stopDepartures(place):
+    stop = place['stop']
+    if place['kind'] == 'wmataStop':
+        return list(wmata.getBusPredictions(stop['id']))
+    elif place['kind'] == 'circulatorStop':
+        if 'stopID' in stop:
+            return list(circulator.getPredictionsByID(stop['stopID']))
+        return [prediction for routeTag in stop['routes']
+                for prediction in circulator.getPredictionsByTag(stop['tag'], routeTag)]
+    else:
+        predictions = art.getPredictions(stop['tag'])
+        return predictions['predictions'] if predictions is not None else []
+
+def nearbyDepartures(longitude, latitude, radius):
+    places = nearbyIndex.near(longitude, latitude, radius, kinds=('wmataStop', 'circulatorStop', 'artStop'),
+                              limit=app.config.get('NEARBY_STOPS', 8))
+    outcomes = fanoutPool.mapUntil(stopDepartures, places, app.config.get('NEARBY_DEADLINE', 2.0))
+
+    departures = []
+    for (place, outcome) in zip(places, outcomes):
+        departure = dict(place, predictions=[])
+        if outcome is None:
+            departure['status'] = 'timeout'
+        elif not outcome[0]:
+            app.logger.warning("Departures for %s %s failed: %r", place['kind'],
+                               place['stop'].get('tag', place['stop'].get('id')), outcome[1])
+            departure['status'] = 'error'
+        else:
+            departure['status'] = 'ok'
+            departure['predictions'] = sorted(outcome[1], key=lambda prediction: prediction['minutes'])
+        departures.append(departure)
+    return departures
+
+@app.route("/nearby/departures")
+def nearby_departures():
+    if 'latitude' in request.args and 'longitude' in request.args:
+        departures = nearbyDepartures(floatArg('longitude'), floatArg('latitude'), floatArg('radius', 0.25))
+        return render_template("nearby_departures.html", departures=departures)
+    else:
+        return render_template("geo.html", destination=url_for('nearby_departures'))
+
+@app.route("/nearby/departures/json")
+def nearby_departures_json():
+    if 'latitude' not in request.args or 'longitude' not in request.args:
+        abort(400, "latitude and longitude are required")
+    departures = nearbyDepartures(floatArg('longitude'), floatArg('latitude'), floatArg('radius', 0.25))
+    return jsonify(departures=toJSON(departures))
+
+STATIC_MAX_AGE = 3600
+
+def generationETag(*generations):
+    return '-'.join('%s.%s' % (marker.name, marker.current()) for marker in generations)
+
+def found(document):
+    if document is None:
+        abort(404)
+    return document
+
+def predictionsJSON(name, peekExpiration, load):
+    expiration = peekExpiration()
+    if secondsUntil(expiration) == 0:
+        (payload, expiration) = load()
+        build = lambda: payload
+    else:
+        build = lambda: load()[0]
+    etag = '%s-%s' % (name, toJSON(expiration)) if expiration is not None else None
+    return cachedJSON(etag, secondsUntil(expiration), build)
+
+def listExpiration(predictions, field='expiration'):
+    return predictions[0][field] if predictions else None
+
+def listAge(predictions):
+    return staleAge(listExpiration(predictions), predictions[0].get('fetched') if predictions else None)
+
+@app.route("/api/v1/wmata/stations")
+def api_wmata_stations():
+    return cachedJSON(generationETag(wmata.stationsGeneration), STATIC_MAX_AGE,
+                      lambda: {'stations': list(wmata.getStations())})
+
+@app.route("/api/v1/wmata/stop/<stopID>")
+def api_wmata_stop(stopID):
+    return cachedJSON(generationETag(wmata.stopsGeneration), STATIC_MAX_AGE,
+                      lambda: {'stop': found(wmata.getStop(stopID))})
+
+@app.route("/api/v1/wmata/stop/<stopID>/predictions")
+def api_wmata_stop_predictions(stopID):
+    def load():
+        predictions = list(wmata.getBusPredictions(stopID))
+        return ({'stopID': stopID, 'predictions': predictions, 'age': listAge(predictions)},
+                listExpiration(predictions))
+    return predictionsJSON('wmataBusPredictions', lambda: wmata.getBusPredictionsExpiration(stopID), load)
+
+@app.route("/api/v1/wmata/station/<path:rtuCodes>/predictions")
+def api_wmata_station_predictions(rtuCodes):
+    board = wmata.getRailBoard()
+    if board is None:
+        return cachedJSON(None, 0, lambda: {'groups': []})
+
+    return cachedJSON('wmataRailPredictions-%s' % board.generation, secondsUntil(board.expiration),
+                      lambda: {'groups': board.station(rtuCodes.split('/'))})
+
+@app.route("/api/v1/circulator/routes")
+def api_circulator_routes():
+    return cachedJSON(generationETag(circulator.routesGeneration), STATIC_MAX_AGE,
+                      lambda: {'routes': list(circulator.getRoutes())})
+
+@app.route("/api/v1/circulator/route/<routeTag>")
+def api_circulator_route(routeTag):
+    return cachedJSON(generationETag(circulator.routesGeneration), STATIC_MAX_AGE,
+                      lambda: {'route': found(circulator.getRoute(routeTag))})
+
+@app.route("/api/v1/circulator/stop/<stopTag>")
+def api_circulator_stop(stopTag):
+    return cachedJSON(generationETag(circulator.stopsGeneration), STATIC_MAX_AGE,
+                      lambda: {'stop': found(circulator.getStopByTag(stopTag))})
+
+@app.route("/api/v1/circulator/stop/id/<int:stopID>/predictions")
+def api_circulator_stop_id_predictions(stopID):
+    def load():
+        predictions = list(circulator.getPredictionsByID(stopID))
+        return ({'stopID': stopID, 'predictions': predictions, 'age': listAge(predictions)},
+                listExpiration(predictions))
+    return predictionsJSON('circulatorPredictions', lambda: circulator.getPredictionsExpirationByID(stopID), load)
+
+@app.route("/api/v1/circulator/stop/<stopTag>/<routeTag>/predictions")
+def api_circulator_stop_tag_predictions(stopTag, routeTag):
+    def load():
+        predictions = list(circulator.getPredictionsByTag(stopTag, routeTag))
+        return ({'stopTag': stopTag, 'routeTag': routeTag, 'predictions': predictions,
+                 'age': listAge(predictions)},
+                listExpiration(predictions))
+    return predictionsJSON('circulatorPredictions',
+                           lambda: circulator.getPredictionsExpirationByTag(stopTag, routeTag), load)
+
+@app.route("/api/v1/art/routes")
+def api_art_routes():
+    return cachedJSON(generationETag(art.routesGeneration), STATIC_MAX_AGE,
+                      lambda: {'routes': list(art.getRoutes())})
+
+@app.route("/api/v1/art/route/<routeNumber>")
+def api_art_route(routeNumber):
+    return cachedJSON(generationETag(art.routesGeneration), STATIC_MAX_AGE,
+                      lambda: {'route': found(art.getRoute(routeNumber))})
+
+@app.route("/api/v1/art/stop/<stopTag>")
+def api_art_stop(stopTag):
+    return cachedJSON(generationETag(art.stopsGeneration), STATIC_MAX_AGE,
+                      lambda: {'stop': found(art.getStop(stopTag))})
+
+@app.route("/api/v1/art/stop/<stopTag>/predictions")
+def api_art_stop_predictions(stopTag):
+    def load():
+        predictions = found(art.getPredictions(stopTag))
+        return ({'stopTag': stopTag, 'predictions': predictions['predictions'],
+                 'age': staleAge(predictions['expires'], predictions.get('fetched'))},
+                predictions['expires'])
+    return predictionsJSON('artPredictions', lambda: art.getPredictionsExpiration(stopTag), load)
+
+@app.route("/status/refresh")
+def refresh_status():
+    return jsonify(wmata=wmata.refresher.getStats(),
+                   circulator=circulator.refresher.getStats(),
+                   art=art.refresher.getStats())
+
+def cacheStats():
+    static = services.get().static
+    return dict(static=static.getStats() if static is not None else {'mapped': False},
+                wmataStops=wmata.stopCache.getStats(),
+                circulatorStops=circulator.stopCache.getStats(),
+                circulatorRoutes=circulator.routeCache.getStats(),
+                circulatorRouteStops=circulator.routeStopsCache.getStats(),
+                artStops=art.stopCache.getStats(),
+                artRoutes=art.routeCache.getStats(),
+                artRouteStops=art.routeStopsCache.getStats(),
+                pages=pageCache.getStats())
+
+@app.route("/status/cache")
+def cache_status():
+    return jsonify(cacheStats())
+
+@app.route("/status/quota")
+def quota_status():
+    return jsonify(wmata=wmata.calls.getStats(),
+                   circulator=circulator.calls.getStats(),
+                   art=art.calls.getStats())
+
+@app.route("/status/upstream")
+def upstream_status():
+    return jsonify(wmata=connectionStats(wmata.rs),
+                   circulator=connectionStats(circulator.rs),
+                   art=connectionStats(art.rs))
+
+@app.route("/status/poller")
+def poller_status():
+    return jsonify(getHealth(db))
+
+def feedLookups():
+    return [((upstream, feed, result), count)
+            for (upstream, client) in [('wmata', wmata), ('circulator', circulator), ('art', art)]
+            for (feed, counts) in client.refresher.getStats().items()
+            for (result, count) in counts.items()]
+
+metrics.registry.add(metrics.Gauges('cti_feed_lookups_total',
+                                    'Expiration checks by outcome: hits found fresh data, fetches refreshed it, '
+                                    'coalesced and waited joined a refresh already running, stale served '
+                                    'expired data, failures are failed refreshes and prefetches refreshed hot '
+                                    'stops ahead of time.',
+                                    ('upstream', 'feed', 'result'), feedLookups, type='counter'))
+metrics.statsGauges('cti_cache', 'LRU and page cache statistics.', ('cache',), cacheStats)
+metrics.statsGauges('cti_upstream_quota', 'Upstream calls today against the daily quota.', ('upstream',),
+                    lambda: dict(wmata=wmata.calls.getStats(), circulator=circulator.calls.getStats(),
+                                 art=art.calls.getStats()))
+
+def startupSeconds():
+    phases = [('import', importSeconds), ('services', services.seconds if services.pid == os.getpid() else None),
+              ('first_request', firstRequestSeconds.get(os.getpid()))]
+    return [((phase,), seconds) for (phase, seconds) in phases if seconds is not None]
+
+metrics.registry.add(metrics.Gauges('cti_startup_seconds',
+                                    'Seconds this process spent importing the app, building its Mongo '
+                                    'connection and agency clients, and serving its first request.',
+                                    ('phase',), startupSeconds))
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+importSeconds = time.time() - importStart
+
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0')
+    app.run(debug=True, host='0.0.0.0', threaded=True)
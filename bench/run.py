@@ -0,0 +1,290 @@
+"""End-to-end benchmark against local stand-in upstreams; needs a mongod nothing else uses."""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH, '..'))
+sys.path.insert(0, BENCH)
+
+from pymongo import Connection
+
+import stubs
+from indexes import ensureIndexes, indexSpec
+
+DB_NAME = 'ctiBench'
+
+MIX = [('station', 25), ('wmataStop', 15), ('circulatorStop', 10), ('artStop', 10),
+       ('stationsGeo', 5), ('stopsGeo', 5), ('nearby', 5), ('index', 10), ('stations', 5),
+       ('railIncidents', 3), ('elesIncidents', 3), ('circulatorRoutes', 2), ('artRoute', 2)]
+
+def writeSettings(urls):
+    (fd, path) = tempfile.mkstemp(suffix='.cfg')
+    with os.fdopen(fd, 'w') as f:
+        f.write("DB_NAME = %r\n" % DB_NAME)
+        f.write("WMATA_KEY = 'bench'\n")
+        f.write("WMATA_BASE_URL = %r\n" % urls['wmata'])
+        f.write("NEXTBUS_BASE_URL = %r\n" % urls['nextbus'])
+        f.write("ART_BASE_URL = %r\n" % urls['connexionz'])
+        f.write("NEXTBUS_REQUESTS_PER_SECOND = None\n")
+    return path
+
+def mongoOps(db):
+    try:
+        counters = db.command('serverStatus')['opcounters']
+    except Exception:
+        return None
+    return dict((key, int(value)) for key, value in counters.items())
+
+def difference(after, before):
+    if after is None or before is None:
+        return None
+    return dict((key, after[key] - before.get(key, 0)) for key in after)
+
+def upstreamCalls(upstreams, outcomes=False):
+    return dict((stub.name, stub.getOutcomes() if outcomes else stub.getCalls()) for stub in upstreams.values())
+
+def callDifference(after, before):
+    return dict((name, dict((endpoint, count - before[name].get(endpoint, 0))
+                            for endpoint, count in after[name].items()
+                            if count - before[name].get(endpoint, 0)))
+                for name in after)
+
+class Phase(object):
+    """Wall time, upstream calls and Mongo operations across a block."""
+
+    def __init__(self, db, upstreams):
+        self.db = db
+        self.upstreams = upstreams
+
+    def __enter__(self):
+        self.calls = upstreamCalls(self.upstreams)
+        self.outcomes = upstreamCalls(self.upstreams, outcomes=True)
+        self.ops = mongoOps(self.db)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.time() - self.start
+        self.calls = callDifference(upstreamCalls(self.upstreams), self.calls)
+        self.outcomes = callDifference(upstreamCalls(self.upstreams, outcomes=True), self.outcomes)
+        self.ops = difference(mongoOps(self.db), self.ops)
+
+    def result(self):
+        return {'seconds': self.seconds, 'upstreamCalls': self.calls, 'upstreamOutcomes': self.outcomes,
+                'mongoOps': self.ops}
+
+def buildRequests(db, count, seed=1):
+    """count page URLs tagged with their kind, skewed towards a hot tenth."""
+    rng = random.Random(seed)
+    stations = ['/'.join(station['rtus']) for station in db['wmataStations'].find().sort('name')]
+    wmataStops = [stop['id'] for stop in db['wmataStops'].find().sort('id')]
+    circulatorStops = [(stop['tag'], route) for stop in db['nextbusStops'].find().sort('tag')
+                       for route in stop['routes']]
+    artStops = [stop['tag'] for stop in db['artStops'].find().sort('tag')]
+    artRoutes = [route['number'] for route in db['artRoutes'].find().sort('number')]
+    locations = [stop['location'] for stop in db['wmataStops'].find().sort('id')]
+
+    def pick(items):
+        if rng.random() < 0.75:
+            return items[rng.randrange(max(1, len(items) / 10))]
+        return rng.choice(items)
+
+    def geo(path):
+        (lon, lat) = pick(locations)
+        return '%s?latitude=%f&longitude=%f' % (path, lat, lon)
+
+    urls = {'station': lambda: '/wmata/station/' + pick(stations),
+            'wmataStop': lambda: '/wmata/bus/stop/' + pick(wmataStops),
+            'circulatorStop': lambda: '/circulator/stop/%s/%s' % pick(circulatorStops),
+            'artStop': lambda: '/art/stop/' + pick(artStops),
+            'stationsGeo': lambda: geo('/wmata/stations/geo'),
+            'stopsGeo': lambda: geo('/wmata/bus/stops/geo'),
+            'nearby': lambda: geo('/nearby'),
+            'index': lambda: '/',
+            'stations': lambda: '/wmata/stations',
+            'railIncidents': lambda: '/wmata/incidents/rail',
+            'elesIncidents': lambda: '/wmata/incidents/eles',
+            'circulatorRoutes': lambda: '/circulator/routes',
+            'artRoute': lambda: '/art/route/' + rng.choice(artRoutes)}
+
+    sources = {'station': stations, 'wmataStop': wmataStops, 'circulatorStop': circulatorStops,
+               'artStop': artStops, 'artRoute': artRoutes, 'stationsGeo': locations,
+               'stopsGeo': locations, 'nearby': locations}
+    kinds = []
+    for (kind, weight) in MIX:
+        if kind in sources and not sources[kind]:
+            print "Nothing loaded for %s pages; leaving them out" % kind
+            continue
+        kinds.extend([kind] * weight)
+    return [(kind, urls[kind]()) for kind in (rng.choice(kinds) for i in xrange(count))]
+
+def drive(app, requests, concurrency):
+    """Play requests through the app on concurrency threads."""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    position = [0]
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                if position[0] >= len(requests):
+                    return
+                (kind, url) = requests[position[0]]
+                position[0] += 1
+            start = time.time()
+            try:
+                status = client.get(url).status_code
+            except Exception:
+                status = 500
+            elapsed = time.time() - start
+            with lock:
+                latencies[kind].append(elapsed)
+                if status >= 500:
+                    errors[kind] += 1
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (latencies, errors)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(values):
+    return {'count': len(values),
+            'p50': percentile(values, 0.50) * 1000,
+            'p95': percentile(values, 0.95) * 1000,
+            'p99': percentile(values, 0.99) * 1000}
+
+def runLoaders(manage, db, upstreams):
+    results = {}
+    for name in ('load_wmata', 'load_circulator', 'load_art'):
+        with Phase(db, upstreams) as phase:
+            try:
+                getattr(manage, name)()
+                failed = None
+            except Exception, e:
+                failed = str(e)
+        results[name] = phase.result()
+        results[name]['failed'] = failed
+    return results
+
+def run(args):
+    upstreams = stubs.startStubs(args.directory, args.latency, args.error_rate)
+    os.environ['CTI_SETTINGS'] = writeSettings(dict((name, stub.url) for name, stub in upstreams.items()))
+    connection = Connection()
+    connection.drop_database(DB_NAME)
+    db = connection[DB_NAME]
+    ensureIndexes(db, indexSpec())
+
+    import manage
+    app = manage.app
+    results = {'settings': {'requests': args.requests, 'concurrency': args.concurrency,
+                            'latency': args.latency, 'errorRate': args.error_rate}}
+    results['loaders'] = runLoaders(manage, db, upstreams)
+    results['reload'] = runLoaders(manage, db, upstreams)
+
+    requests = buildRequests(db, args.requests)
+    with Phase(db, upstreams) as phase:
+        (latencies, errors) = drive(app, requests, args.concurrency)
+    pages = phase.result()
+    pages['throughput'] = len(requests) / phase.seconds
+    pages['errors'] = dict(errors)
+    pages['latency'] = dict((kind, summarize(values)) for kind, values in latencies.items())
+    pages['latency']['all'] = summarize([value for values in latencies.values() for value in values])
+    results['pages'] = pages
+
+    for stub in upstreams.values():
+        stub.stop()
+    os.remove(os.environ['CTI_SETTINGS'])
+    return results
+
+def total(counts):
+    if counts is None:
+        return None
+    return sum(value for value in counts.values() if isinstance(value, int)) + \
+           sum(total(value) for value in counts.values() if isinstance(value, dict))
+
+def change(current, baseline):
+    if current is None or not baseline:
+        return ''
+    return '%+.1f%%' % (100.0 * (current - baseline) / baseline)
+
+def report(results, baseline):
+    def base(*path):
+        value = baseline
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    print "%-24s %7s %9s %9s %9s" % ('loader', 'seconds', 'upstream', 'mongo ops', 'vs base')
+    for phase in ('loaders', 'reload'):
+        for (name, result) in sorted(results[phase].items()):
+            label = name if phase == 'loaders' else name + ' (again)'
+            print "%-24s %7.2f %9d %9s %9s" % (label, result['seconds'], total(result['upstreamCalls']),
+                                              total(result['mongoOps']),
+                                              change(result['seconds'], base(phase, name, 'seconds')))
+            if result['failed']:
+                print "  failed: %s" % result['failed']
+
+    pages = results['pages']
+    print
+    print "%-24s %7s %9s %9s %9s %7s %11s" % ('page', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'errors',
+                                              'p95 vs base')
+    for (kind, stats) in sorted(pages['latency'].items(), key=lambda item: (item[0] == 'all', item[0])):
+        errors = sum(pages['errors'].values()) if kind == 'all' else pages['errors'].get(kind, 0)
+        print "%-24s %7d %9.1f %9.1f %9.1f %7d %11s" % (kind, stats['count'], stats['p50'], stats['p95'],
+                                                       stats['p99'], errors,
+                                                       change(stats['p95'], base('pages', 'latency', kind, 'p95')))
+    print
+    print "throughput     %8.1f req/s %s" % (pages['throughput'], change(pages['throughput'],
+                                                                          base('pages', 'throughput')))
+    print "upstream calls %8d %s" % (total(pages['upstreamCalls']), change(total(pages['upstreamCalls']),
+                                                                         total(base('pages', 'upstreamCalls'))))
+    for (name, calls) in sorted(pages['upstreamCalls'].items()):
+        calls = dict(calls, **pages['upstreamOutcomes'][name])
+        print "  %-12s %s" % (name, ', '.join('%s=%d' % item for item in sorted(calls.items())))
+    if pages['mongoOps'] is not None:
+        print "mongo ops      %8d %s" % (total(pages['mongoOps']), change(total(pages['mongoOps']),
+                                                                         total(base('pages', 'mongoOps'))))
+        print "  " + ', '.join('%s=%d' % item for item in sorted(pages['mongoOps'].items()))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app against local stand-in upstreams.')
+    parser.add_argument('directory', nargs='?', default=os.path.join(BENCH, 'fixtures', 'stub'))
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean upstream latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream calls that fail')
+    parser.add_argument('--baseline', default=os.path.join(BENCH, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        baseline = json.load(open(args.baseline))
+        if baseline.get('settings') != results['settings']:
+            print "Baseline was recorded with %s; comparing anyway" % baseline.get('settings')
+    report(results, baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "Saved baseline to %s" % args.baseline
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Local stand-ins for the WMATA, NextBus and Connexionz APIs."""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from datetime import datetime, timedelta
+from SocketServer import ThreadingMixIn
+
+from lxml import etree
+
+NS = 'urn:connexionz-co-nz'
+
+LINES = {'A': ['RD'], 'B': ['RD'], 'C': ['OR', 'BL'], 'D': ['OR', 'BL'], 'E': ['GR', 'YL'],
+         'F': ['GR', 'YL'], 'G': ['BL'], 'J': ['BL'], 'K': ['OR']}
+TRANSFERS = {'C01': 'A01', 'F01': 'B01', 'F03': 'D03', 'E06': 'B06'}
+CIRCULATOR_ROUTES = ['gtwn', 'yellow', 'rosslyn', 'potomac', 'union', 'navy']
+
+def location(rng):
+    return (38.9 + rng.uniform(-0.12, 0.12), -77.03 + rng.uniform(-0.15, 0.15))
+
+def stationCodes():
+    codes = []
+    for letter in sorted(LINES):
+        codes.extend('%s%02d' % (letter, i) for i in range(1, 11))
+    return codes
+
+def generateStations(rng):
+    stations = []
+    places = {}
+    for code in stationCodes():
+        if code in TRANSFERS:
+            (name, lat, lon) = places[TRANSFERS[code]]
+        else:
+            (lat, lon) = location(rng)
+            name = 'Station %s' % code
+        places[code] = (name, lat, lon)
+        station = {'Code': code, 'Name': name, 'Lat': lat, 'Lon': lon}
+        for (i, line) in enumerate(LINES[code[0]]):
+            station['LineCode%d' % (i + 1)] = line
+        stations.append(station)
+    return json.dumps({'Stations': stations})
+
+def generateStops(rng):
+    stops = []
+    for i in range(3000):
+        (lat, lon) = location(rng)
+        name = None if rng.random() < 0.02 else '%d ST NW + %s ST NW' % (rng.randint(1, 40), chr(65 + i % 26))
+        stops.append({'StopID': str(1000000 + i), 'Name': name, 'Lat': lat, 'Lon': lon, 'Routes': []})
+    return json.dumps({'Stops': stops})
+
+def generateRailPredictions(rng):
+    trains = []
+    for code in stationCodes():
+        for group in ('1', '2'):
+            for i in range(3):
+                trains.append({'Car': rng.choice(['6', '8']),
+                               'Destination': 'Dest', 'DestinationCode': code,
+                               'DestinationName': 'Dest %s' % group,
+                               'Group': group,
+                               'Line': rng.choice(LINES[code[0]]),
+                               'LocationCode': code,
+                               'LocationName': 'Station %s' % code,
+                               'Min': rng.choice(['BRD', 'ARR'] + [str(m) for m in range(1, 20)])})
+    return json.dumps({'Trains': trains})
+
+def generateRailIncidents(rng):
+    return json.dumps({'Incidents': [{'LinesAffected': '%s;' % line, 'Description': 'Delays on the %s line.' % line,
+                                      'IncidentType': 'Delay'} for line in ('RD', 'OR', 'GR')]})
+
+def generateELESIncidents(rng):
+    incidents = []
+    for i in range(40):
+        incidents.append({'DisplayOrder': str(i), 'LocationDescription': 'Escalator between mezzanine and platform',
+                          'StationCode': rng.choice(stationCodes()), 'SymptomDescription': 'Service Call',
+                          'UnitName': 'U%03d' % i, 'UnitStatus': 'O',
+                          'UnitType': rng.choice(['ELEVATOR', 'ESCALATOR'])})
+    return json.dumps({'ElevatorIncidents': incidents})
+
+def circulatorStops():
+    stops = {}
+    for (r, route) in enumerate(CIRCULATOR_ROUTES):
+        stops[route] = ['s%d' % ((r * 25 + i) % 160) for i in range(30)]
+    return stops
+
+def generateRouteList(rng):
+    return '<body>%s</body>' % ''.join('<route tag="%s" title="%s"/>' % (route, route.title())
+                                       for route in CIRCULATOR_ROUTES)
+
+def generateRouteConfigs(rng):
+    pieces = ['<body>']
+    places = {}
+    for (route, stops) in sorted(circulatorStops().items()):
+        pieces.append('<route tag="%s" title="%s">' % (route, route.title()))
+        for stop in stops:
+            if stop not in places:
+                places[stop] = location(rng)
+            pieces.append('<stop tag="%s" title="Stop %s" lat="%f" lon="%f" stopId="%d"/>' %
+                          (stop, stop, places[stop][0], places[stop][1], 9000 + int(stop[1:])))
+        for (tag, title, order) in (('%s_0' % route, 'Outbound', stops), ('%s_1' % route, 'Inbound', stops[::-1])):
+            pieces.append('<direction tag="%s" title="%s" useForUI="true">' % (tag, title))
+            pieces.extend('<stop tag="%s"/>' % stop for stop in order)
+            pieces.append('</direction>')
+        pieces.append('</route>')
+    pieces.append('</body>')
+    return ''.join(pieces)
+
+def generatePlatforms(rng):
+    pieces = ['<Platforms xmlns="%s">' % NS]
+    for i in range(1, 401):
+        (lat, lon) = location(rng)
+        pieces.append('<Platform PlatformTag="%d" PlatformNo="%05d" Name="Platform %d">'
+                      '<Position Lat="%f" Long="%f"/></Platform>' % (i, 41000 + i, i, lat, lon))
+    pieces.append('</Platforms>')
+    return ''.join(pieces)
+
+def generateRoutePatterns(rng):
+    pieces = ['<RoutePattern><Project>']
+    for number in range(41, 56):
+        pieces.append('<Route RouteNo="%d" Name="Route %d">' % (number, number))
+        for (direction, destination) in (('E', 'East'), ('W', 'West')):
+            pieces.append('<Destination Name="%s"><Pattern Schedule="Active" Direction="%s" '
+                          'RouteTag="%d%s" Name="%d %s">' % (destination, direction, number, direction,
+                                                            number, destination))
+            pieces.extend('<Platform PlatformTag="%d"/>' % rng.randint(1, 400) for i in range(25))
+            pieces.append('</Pattern></Destination>')
+        pieces.append('</Route>')
+    pieces.append('</Project></RoutePattern>')
+    return ''.join(pieces)
+
+def generateBusPredictions(rng, query):
+    return json.dumps({'StopName': 'Stop %s' % query.get('StopID'),
+                       'Predictions': [{'RouteID': str(rng.randint(1, 99)), 'DirectionText': 'North',
+                                        'DirectionNum': '0', 'Minutes': rng.randint(0, 40)}
+                                       for i in range(rng.randint(0, 6))]})
+
+def generateNextBusPredictions(rng, query):
+    minutes = sorted(rng.randint(0, 30) for i in range(rng.randint(0, 4)))
+    return '<body><predictions routeTitle="%s"><direction title="Outbound">%s</direction></predictions></body>' % \
+           (query.get('r', 'Circulator'), ''.join('<prediction minutes="%d"/>' % m for m in minutes))
+
+def generateArrivals(rng, query):
+    return '<RoutePositionET xmlns="%s"><Content Expires="2000-01-01T00:00:00Z"/><Platform PlatformTag="%s">' \
+           '<Route RouteNo="%d"><Destination Name="East">%s</Destination></Route></Platform></RoutePositionET>' % \
+           (NS, query.get('PlatformTag'), rng.randint(41, 55),
+            ''.join('<Trip ETA="%d"/>' % rng.randint(0, 30) for i in range(rng.randint(0, 4))))
+
+FIXTURES = [('JStops.json', generateStops),
+            ('JStations.json', generateStations),
+            ('GetPrediction.json', generateRailPredictions),
+            ('Incidents.json', generateRailIncidents),
+            ('ElevatorIncidents.json', generateELESIncidents),
+            ('routeList.xml', generateRouteList),
+            ('routeConfig.xml', generateRouteConfigs),
+            ('Platform.xml', generatePlatforms),
+            ('RoutePattern.rxml', generateRoutePatterns)]
+
+def ensureFixtures(directory, seed=1):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(seed)
+    for (name, generate) in FIXTURES:
+        content = generate(rng)
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(content)
+
+def freshExpiration(body):
+    expires = (datetime.utcnow() + timedelta(seconds=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return re.sub(r'Expires="[^"]*"', 'Expires="%s"' % expires, body, count=1)
+
+class Fixtures(object):
+    """Fixture bodies by name, read once, plus per-request generated ones."""
+
+    def __init__(self, directory, seed=1):
+        self.directory = directory
+        self.seed = seed
+        self.files = {}
+        self.routeConfigs = None
+
+    def read(self, name):
+        if name not in self.files:
+            path = os.path.join(self.directory, name)
+            self.files[name] = open(path, 'rb').read() if os.path.exists(path) else None
+        return self.files[name]
+
+    def static(self, name):
+        return lambda query: self.read(name)
+
+    def perRequest(self, name, generate, key):
+        def respond(query):
+            recorded = self.read(name)
+            if recorded is not None:
+                return recorded
+            return generate(random.Random('%s:%s:%d' % (name, query.get(key), int(time.time() / 20))), query)
+        return respond
+
+    def routeConfig(self, query):
+        if 'r' not in query:
+            return self.read('routeConfig.xml')
+        if self.routeConfigs is None:
+            self.routeConfigs = dict((route.get('tag'), '<body>%s</body>' % etree.tostring(route))
+                                     for route in etree.fromstring(self.read('routeConfig.xml')).iterchildren('route'))
+        return self.routeConfigs.get(query['r'], '<body><Error shouldRetry="false">No route</Error></body>')
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        (endpoint, respond, static) = server.route(url.path, query)
+        server.count(endpoint)
+
+        if server.latency:
+            time.sleep(server.latency * server.rng.uniform(0.5, 1.5))
+        if respond is None or server.rng.random() < server.errorRate:
+            if respond is not None:
+                server.count('errors', outcome=True)
+            self.send_response(503 if respond is not None else 404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = respond(query)
+        if endpoint == 'RoutePositionET':
+            body = freshExpiration(body)
+        headers = {}
+        if static:
+            headers['ETag'] = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                server.count('notModified', outcome=True)
+                self.send_response(304)
+                self.send_header('ETag', headers['ETag'])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if body.startswith('{') else 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubUpstream(ThreadingMixIn, HTTPServer):
+    """One fake upstream API on a free local port."""
+    daemon_threads = True
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, name, routes, latency=0.0, errorRate=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.name = name
+        self.routes = routes
+        self.latency = latency
+        self.errorRate = errorRate
+        self.rng = random.Random()
+        self.calls = defaultdict(int)
+        self.outcomes = defaultdict(int)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def route(self, path, query):
+        for (key, value) in query.items():
+            if (path, key, value) in self.routes:
+                return self.routes[(path, key, value)]
+        return self.routes.get(path, ('unknown', None, False))
+
+    def count(self, endpoint, outcome=False):
+        with self.lock:
+            (self.outcomes if outcome else self.calls)[endpoint] += 1
+
+    def getCalls(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def getOutcomes(self):
+        with self.lock:
+            return dict(self.outcomes)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def startStubs(directory, latency=0.0, errorRate=0.0, seed=1):
+    """Start stand-ins for all three upstreams; returns {name: StubUpstream}."""
+    ensureFixtures(directory, seed)
+    fixtures = Fixtures(directory, seed)
+    feed = '/service/publicXMLFeed'
+    utility = '/rtt/public/utility/file.aspx'
+    routes = {
+        'wmata': {'/Bus.svc/json/JStops': ('JStops', fixtures.static('JStops.json'), True),
+                  '/Rail.svc/json/JStations': ('JStations', fixtures.static('JStations.json'), True),
+                  '/StationPrediction.svc/json/GetPrediction/All':
+                      ('GetPrediction', fixtures.static('GetPrediction.json'), False),
+                  '/Incidents.svc/json/Incidents': ('Incidents', fixtures.static('Incidents.json'), False),
+                  '/Incidents.svc/json/ElevatorIncidents':
+                      ('ElevatorIncidents', fixtures.static('ElevatorIncidents.json'), False),
+                  '/NextBusService.svc/json/JPredictions':
+                      ('JPredictions', fixtures.perRequest('JPredictions.json', generateBusPredictions, 'StopID'),
+                       False)},
+        'nextbus': {(feed, 'command', 'routeList'): ('routeList', fixtures.static('routeList.xml'), False),
+                    (feed, 'command', 'routeConfig'): ('routeConfig', fixtures.routeConfig, False),
+                    (feed, 'command', 'predictions'):
+                        ('predictions', fixtures.perRequest('predictions.xml', generateNextBusPredictions, 's'),
+                         False)},
+        'connexionz': {(utility, 'Name', 'Platform.xml'): ('Platform', fixtures.static('Platform.xml'), True),
+                       (utility, 'Name', 'RoutePattern.rxml'):
+                           ('RoutePattern', fixtures.static('RoutePattern.rxml'), True),
+                       (utility, 'Name', 'RoutePositionET.xml'):
+                           ('RoutePositionET',
+                            fixtures.perRequest('RoutePositionET.xml', generateArrivals, 'PlatformTag'), False)}}
+    return dict((name, StubUpstream(name, routes[name], latency, errorRate).start()) for name in routes)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stand-in upstream APIs until interrupted.')
+    parser.add_argument('directory', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'stub'))
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses that fail')
+    args = parser.parse_args()
+
+    stubs = startStubs(args.directory, args.latency, args.error_rate)
+    print "WMATA_BASE_URL = %r" % stubs['wmata'].url
+    print "NEXTBUS_BASE_URL = %r" % stubs['nextbus'].url
+    print "ART_BASE_URL = %r" % stubs['connexionz'].url
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        for stub in stubs.values():
+            print stub.name, stub.getCalls(), stub.getOutcomes()
+            stub.stop()
+
+if __name__ == "__main__":
+    main()
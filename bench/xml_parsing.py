@@ -0,0 +1,185 @@
+"""Compare the streaming feed parsers against the old XPath ones on large files."""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lxml import etree
+
+import connexionz
+import nextbus
+
+NSMAP = connexionz.NSMAP
+
+def legacyPlatforms(content, agency):
+    stopTree = etree.fromstring(content)
+    stopsOut = []
+    for stop in stopTree.xpath('/c:Platforms/c:Platform', namespaces=NSMAP):
+        position = stop.xpath('./c:Position', namespaces=NSMAP)[0]
+        stopData = {'agency': agency,
+                    'name': stop.attrib['Name'],
+                    'tag': stop.attrib['PlatformTag'],
+                    'location': [float(position.attrib['Long']), float(position.attrib['Lat'])]}
+        if 'PlatformNo' in stop.attrib:
+            stopData['number'] = stop.attrib['PlatformNo']
+        position = stop.xpath('c:Position', namespaces=NSMAP)[0]
+        stopsOut.append(stopData)
+    return stopsOut
+
+def legacyRoutePatterns(content, agency):
+    routeTree = etree.fromstring(content)
+    routesOut = []
+    for route in routeTree.xpath('/RoutePattern/Project/Route'):
+        routeData = {'agency': agency,
+                     'number': route.attrib['RouteNo'],
+                     'name': route.attrib['Name'],
+                     'patterns': {}}
+        for pattern in route.xpath('Destination/Pattern'):
+            if pattern.attrib['Schedule'] != 'Active':
+                continue
+            patternData = {'destinationName': pattern.xpath('../@Name')[0],
+                           'direction': pattern.attrib['Direction'],
+                           'routeTag': pattern.attrib['RouteTag'],
+                           'name': pattern.attrib['Name'],
+                           'platforms': []}
+            for platform in pattern.xpath('Platform'):
+                patternData['platforms'].append(platform.attrib['PlatformTag'])
+            routeData['patterns'][patternData['routeTag']] = patternData
+        routesOut.append(routeData)
+    return routesOut
+
+def legacyArrivals(content, agency):
+    predictionsTree = etree.fromstring(content)
+    predictions = []
+    for trip in predictionsTree.xpath('/c:RoutePositionET/c:Platform/c:Route/c:Destination/c:Trip',
+                                      namespaces=NSMAP):
+        predictions.append({'minutes': int(trip.attrib['ETA']),
+                            'destination': trip.xpath('../@Name')[0],
+                            'route': trip.xpath('../../@RouteNo')[0]})
+    return predictions
+
+def legacyRouteConfigs(content, agency):
+    routeTree = etree.fromstring(content)
+    routesOut = []
+    for route in routeTree.xpath("/body/route"):
+        routeData = {'agency': agency, 'tag': route.attrib['tag'], 'directions': {}}
+        for direction in route.xpath("./direction[@useForUI='true']"):
+            routeData['directions'][direction.attrib['tag']] = \
+                [stop.attrib['tag'] for stop in direction.xpath("./stop")]
+        stops = []
+        for stop in route.xpath("./stop"):
+            stops.append({'agency': agency,
+                          'tag': stop.attrib['tag'],
+                          'location': [float(stop.attrib['lon']), float(stop.attrib['lat'])]})
+        routesOut.append((routeData, stops))
+    return routesOut
+
+def generatePlatforms(count):
+    yield '<Platforms xmlns="%s">' % NSMAP['c']
+    for i in xrange(count):
+        yield '<Platform PlatformTag="%d" PlatformNo="%05d" Name="Platform %d">' \
+              '<Position Lat="%f" Long="%f"/></Platform>' % \
+              (i, i, i, 38.9 + random.random() / 10, -77.1 + random.random() / 10)
+    yield '</Platforms>'
+
+def generateRoutePatterns(count):
+    yield '<RoutePattern><Project>'
+    for i in xrange(count):
+        yield '<Route RouteNo="%d" Name="Route %d">' % (i, i)
+        for d in range(2):
+            yield '<Destination Name="Destination %d">' % d
+            yield '<Pattern Schedule="Active" Direction="%d" RouteTag="%d-%d" Name="P">' % (d, i, d)
+            for p in range(60):
+                yield '<Platform PlatformTag="%d"/>' % random.randint(0, 5000)
+            yield '</Pattern></Destination>'
+        yield '</Route>'
+    yield '</Project></RoutePattern>'
+
+def generateArrivals(count):
+    yield '<RoutePositionET xmlns="%s"><Content Expires="2012-04-01T12:00:00-04:00"/>' % NSMAP['c']
+    yield '<Platform PlatformTag="1">'
+    for i in xrange(count):
+        yield '<Route RouteNo="%d"><Destination Name="D%d">' % (i, i)
+        for t in range(5):
+            yield '<Trip ETA="%d"/>' % random.randint(0, 45)
+        yield '</Destination></Route>'
+    yield '</Platform></RoutePositionET>'
+
+def generateRouteConfigs(count):
+    yield '<body>'
+    for i in xrange(count):
+        yield '<route tag="r%d" title="Route %d">' % (i, i)
+        for s in range(80):
+            yield '<stop tag="s%d" title="Stop %d" lat="%f" lon="%f" stopId="%d"/>' % \
+                  (s, s, 38.9 + random.random() / 10, -77 + random.random() / 10, s)
+        for d in range(2):
+            yield '<direction tag="d%d" title="D" useForUI="true">' % d
+            for s in range(80):
+                yield '<stop tag="s%d"/>' % s
+            yield '</direction>'
+        yield '</route>'
+    yield '</body>'
+
+FIXTURES = [('Platform.xml', generatePlatforms, 200000),
+            ('RoutePattern.rxml', generateRoutePatterns, 5000),
+            ('RoutePositionET.xml', generateArrivals, 100000),
+            ('routeConfig.xml', generateRouteConfigs, 1000)]
+
+CASES = [('Platform.xml', legacyPlatforms,
+          lambda chunks: list(connexionz.parsePlatforms(chunks, 'ART'))),
+         ('RoutePattern.rxml', legacyRoutePatterns,
+          lambda chunks: list(connexionz.parseRoutePatterns(chunks, 'ART'))),
+         ('RoutePositionET.xml', legacyArrivals,
+          lambda chunks: connexionz.parsePredictions(chunks, 'ART', '1')['predictions']),
+         ('routeConfig.xml', legacyRouteConfigs,
+          lambda chunks: list(nextbus.parseRouteConfigs(chunks, 'dc-circulator')))]
+
+def ensureFixtures(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for (name, generate, count) in FIXTURES:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                for piece in generate(count):
+                    f.write(piece)
+
+def fileChunks(path, chunkSize=16384):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                return
+            yield chunk
+
+def measure(run):
+    """Run in a forked child; return (seconds, peak RSS in KB, result count)."""
+    (readFD, writeFD) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readFD)
+        start = time.time()
+        count = len(run())
+        os.write(writeFD, '%f %d' % (time.time() - start, count))
+        os._exit(0)
+    os.close(writeFD)
+    (seconds, count) = os.read(readFD, 100).split()
+    os.close(readFD)
+    (pid, status, usage) = os.wait4(pid, 0)
+    return (float(seconds), usage.ru_maxrss, int(count))
+
+def main(directory):
+    ensureFixtures(directory)
+    print "%-22s %-10s %10s %14s %10s" % ('fixture', 'parser', 'seconds', 'peak RSS (MB)', 'items')
+    for (name, legacy, streaming) in CASES:
+        path = os.path.join(directory, name)
+        results = [('fromstring', measure(lambda: legacy(open(path, 'rb').read(), 'ART'))),
+                   ('streaming', measure(lambda: streaming(fileChunks(path))))]
+        for (parser, (seconds, maxrss, count)) in results:
+            print "%-22s %-10s %10.3f %14.1f %10d" % (name, parser, seconds, maxrss / 1024.0, count)
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else
+         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'large'))
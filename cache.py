@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class DataGeneration(object):
+    """A data version the loaders bump, re-read every checkInterval seconds."""
+
+    def __init__(self, db, name, checkInterval=5):
+        self.generationsCollection = db['dataGenerations']
+        self.name = name
+        self.checkInterval = checkInterval
+        self.generation = None
+        self.checked = 0
+
+    def current(self, fresh=False):
+        if fresh or time.time() - self.checked > self.checkInterval:
+            marker = self.generationsCollection.find_one({'_id': self.name})
+            self.generation = marker['generation'] if marker is not None else 0
+            self.checked = time.time()
+        return self.generation
+
+    def bump(self):
+        self.generationsCollection.update({'_id': self.name}, {'$inc': {'generation': 1}},
+                                          upsert=True)
+        self.checked = 0
+
+class LRUCache(object):
+    """Bounded TTL cache, emptied when any of its generations moves on."""
+
+    def __init__(self, maxSize=1000, ttl=600, generations=()):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.generations = generations
+        self.generation = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def _checkGeneration(self):
+        generation = tuple(marker.current() for marker in self.generations)
+        if generation != self.generation:
+            if self.entries:
+                self.stats['invalidations'] += 1
+            self.entries.clear()
+            self.generation = generation
+
+    def lookup(self, key):
+        with self.lock:
+            self._checkGeneration()
+            entry = self.entries.pop(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires > time.time():
+                    self.entries[key] = entry
+                    self.stats['hits'] += 1
+                    return value
+                self.stats['expirations'] += 1
+            self.stats['misses'] += 1
+            return _MISSING
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get(self, key, load):
+        value = self.lookup(key)
+        if value is _MISSING:
+            value = load()
+            self.store(key, value)
+        return value
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.entries)
+        return stats
+
+class FragmentCache(object):
+    """Rendered pages by key and data version, capped at maxBytes."""
+
+    def __init__(self, maxBytes=8 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def _drop(self, key):
+        (version, value, size) = self.entries.pop(key)
+        self.size -= size
+
+    def lookup(self, key, version):
+        with self.lock:
+            entry = self.entries.pop(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] == version:
+                    self.entries[key] = entry
+                    self.stats['hits'] += 1
+                    return entry[1]
+                self.size -= entry[2]
+                self.stats['invalidations'] += 1
+            self.stats['misses'] += 1
+            return _MISSING
+
+    def store(self, key, version, value):
+        size = len(value.encode('utf-8')) if isinstance(value, unicode) else len(value)
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (version, value, size)
+            self.size += size
+            while self.size > self.maxBytes:
+                self._drop(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def get(self, key, version, render):
+        value = self.lookup(key, version)
+        if value is _MISSING:
+            value = render()
+            self.store(key, version, value)
+        return value
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.size
+            stats['maxBytes'] = self.maxBytes
+        return stats
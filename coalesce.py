@@ -0,0 +1,184 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from Queue import Queue
+
+from pymongo.errors import DuplicateKeyError
+
+log = logging.getLogger(__name__)
+
+class SingleFlight(object):
+    """One refresh per key at a time: locks across threads, leases across processes."""
+
+    def __init__(self, db, leaseSeconds=30, pollInterval=0.1, graceSeconds=60, maxGraceSeconds=900,
+                 backgroundWorkers=4):
+        self.leasesCollection = db['refreshLeases']
+        self.leaseSeconds = leaseSeconds
+        self.pollInterval = pollInterval
+        self.graceSeconds = graceSeconds
+        self.maxGraceSeconds = maxGraceSeconds
+        self.backgroundWorkers = backgroundWorkers
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.locks = {}
+        self.locksLock = threading.Lock()
+        self.stats = defaultdict(lambda: {'hits': 0, 'fetches': 0, 'coalesced': 0, 'waited': 0,
+                                          'stale': 0, 'failures': 0, 'prefetches': 0})
+        self.failures = {}
+        self.prefetcher = None
+        self.queue = None
+        self.queued = set()
+
+    def _lockFor(self, key):
+        with self.locksLock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            return self.locks[key]
+
+    def _count(self, key, counter):
+        feed = key.split(':')[0]
+        with self.locksLock:
+            self.stats[feed][counter] += 1
+
+    def _acquireLease(self, key):
+        now = datetime.utcnow()
+        try:
+            self.leasesCollection.update({'_id': key, 'expires': {'$lt': now}},
+                                         {'$set': {'owner': self.owner,
+                                                   'expires': now + timedelta(seconds=self.leaseSeconds)}},
+                                         upsert=True, safe=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def _releaseLease(self, key):
+        self.leasesCollection.remove({'_id': key, 'owner': self.owner})
+
+    def _waitForLease(self, key, isFresh):
+        deadline = time.time() + self.leaseSeconds
+        while time.time() < deadline:
+            if isFresh():
+                return
+            if self.leasesCollection.find_one({'_id': key, 'expires': {'$gte': datetime.utcnow()}}) is None:
+                return
+            time.sleep(self.pollInterval)
+
+    def hit(self, key):
+        """Count a lookup that found key fresh and needed no refresh."""
+        self._count(key, 'hits')
+
+    def refresh(self, key, isFresh, fetch, hasPrevious=False):
+        """Run fetch() for key unless another thread or process already is."""
+        lock = self._lockFor(key)
+        if not lock.acquire(False):
+            self._count(key, 'coalesced')
+            if hasPrevious:
+                return False
+            self._count(key, 'waited')
+            lock.acquire()
+            lock.release()
+            return False
+
+        try:
+            if isFresh():
+                self._count(key, 'coalesced')
+                return False
+
+            if not self._acquireLease(key):
+                self._count(key, 'coalesced')
+                if not hasPrevious:
+                    self._count(key, 'waited')
+                    self._waitForLease(key, isFresh)
+                return False
+
+            try:
+                fetch()
+                self._count(key, 'fetches')
+            finally:
+                self._releaseLease(key)
+            return True
+        finally:
+            lock.release()
+
+    def _refresh(self, key, isFresh, fetch, hasPrevious):
+        """refresh(), falling back to previous data when the fetch fails."""
+        feed = key.split(':')[0]
+        try:
+            refreshed = self.refresh(key, isFresh, fetch, hasPrevious)
+        except Exception:
+            self._count(key, 'failures')
+            with self.locksLock:
+                self.failures[feed] = self.failures.get(feed, 0) + 1
+            if not hasPrevious:
+                raise
+            log.warning("Refreshing %s failed, serving stale data", key, exc_info=True)
+            return False
+        if refreshed:
+            with self.locksLock:
+                self.failures.pop(feed, None)
+        return refreshed
+
+    def _work(self):
+        while True:
+            (key, isFresh, fetch) = self.queue.get()
+            try:
+                self._refresh(key, isFresh, fetch, True)
+            except Exception:
+                log.exception("Background refresh of %s failed", key)
+            finally:
+                with self.locksLock:
+                    self.queued.discard(key)
+
+    def _refreshInBackground(self, key, isFresh, fetch):
+        with self.locksLock:
+            if key in self.queued:
+                return
+            self.queued.add(key)
+            if self.queue is None:
+                self.queue = Queue()
+                for i in range(self.backgroundWorkers):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+        self.queue.put((key, isFresh, fetch))
+
+    def grace(self, key):
+        """Seconds past expiration that key's data may still be served."""
+        failures = self.failures.get(key.split(':')[0], 0)
+        return min(self.maxGraceSeconds, self.graceSeconds * 2 ** min(failures, 16))
+
+    def prefetch(self, key, isFresh, fetch):
+        """Refresh key ahead of its expiration; failures are logged, not raised."""
+        refreshed = self._refresh(key, isFresh, fetch, True)
+        if refreshed:
+            self._count(key, 'prefetches')
+        return refreshed
+
+    def revalidate(self, key, expiration, isFresh, fetch, prefetch=True):
+        """Serve stale data within its grace window while it refreshes in the background."""
+        if prefetch and self.prefetcher is not None and expiration is not None:
+            self.prefetcher.touch(key, isFresh, fetch)
+        if expiration is not None:
+            overdue = (datetime.utcnow() - expiration.replace(tzinfo=None)).total_seconds()
+            if overdue <= 0:
+                self.hit(key)
+                return False
+            if overdue <= self.grace(key):
+                self._count(key, 'stale')
+                self._refreshInBackground(key, isFresh, fetch)
+                return False
+        return self._refresh(key, isFresh, fetch, expiration is not None)
+
+    def getStats(self):
+        with self.locksLock:
+            return dict((feed, dict(counts)) for feed, counts in self.stats.items())
+
+def freshnessCheck(collection, query=None, field='expiration'):
+    """isFresh(margin) for the cached documents matching query."""
+    def isFresh(margin=0):
+        expiration = collection.find_one(query or {}, fields={field: '1'})
+        return expiration is not None and expiration[field] >= datetime.utcnow() + timedelta(seconds=margin)
+    return isFresh
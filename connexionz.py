@@ -1,129 +1,289 @@
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta
 
-import requests
-from lxml import etree
 
-from pymongo import Connection, GEO2D
+from pymongo import Connection
 from pyrfc3339 import parse
 
 from pprint import pprint
 
+from cache import DataGeneration, LRUCache
+from coalesce import SingleFlight, freshnessCheck
+from loader import BulkLoader, LoadSummary
+from quota import CallCounter
+from staticdata import staticTable
+from upstream import ConditionalGet, upstreamSession
+from xmlstream import iterElements, release, responseChunks
+
+log = logging.getLogger(__name__)
+
 NSMAP = {'c': 'urn:connexionz-co-nz'}
+NS = '{' + NSMAP['c'] + '}'
+
+def parsePlatforms(chunks, agency):
+    for event, platform in iterElements(chunks, tags=[NS + 'Platform']):
+        position = platform.find(NS + 'Position')
+        stopData = {'agency': agency,
+                    'name': platform.attrib['Name'],
+                    'tag': platform.attrib['PlatformTag'],
+                    'location': [float(position.attrib['Long']), float(position.attrib['Lat'])]}
+        if 'PlatformNo' in platform.attrib:
+            stopData['number'] = platform.attrib['PlatformNo']
+        release(platform)
+        yield stopData
+
+def parseRoutePatterns(chunks, agency):
+    routeData = None
+    destinationName = None
+    for event, element in iterElements(chunks, tags=['Route', 'Destination', 'Pattern'],
+                                       events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'Route':
+                routeData = {'agency': agency,
+                             'number': element.attrib['RouteNo'],
+                             'name': element.attrib['Name'],
+                             'patterns': {}}
+            elif element.tag == 'Destination':
+                destinationName = element.attrib['Name']
+        elif element.tag == 'Pattern':
+            if element.attrib['Schedule'] == 'Active':
+                patternData = {'destinationName': destinationName,
+                               'direction': element.attrib['Direction'],
+                               'routeTag': element.attrib['RouteTag'],
+                               'name': element.attrib['Name'],
+                               'platforms': [platform.attrib['PlatformTag']
+                                             for platform in element.iterchildren('Platform')]}
+                routeData['patterns'][patternData['routeTag']] = patternData
+            release(element)
+        elif element.tag == 'Route':
+            release(element)
+            yield routeData
+
+def parsePredictions(chunks, agency, stopTag):
+    predictionData = {'agency': agency,
+                      'tag': stopTag,
+                      'predictions': []}
+    routeNumber = None
+    destinationName = None
+    for event, element in iterElements(chunks, tags=[NS + 'Content', NS + 'Route', NS + 'Destination', NS + 'Trip'],
+                                       events=('start', 'end')):
+        if event == 'start':
+            if element.tag == NS + 'Content':
+                predictionData['expires'] = parse(element.attrib['Expires'], utc=True)
+            elif element.tag == NS + 'Route':
+                routeNumber = element.attrib['RouteNo']
+            elif element.tag == NS + 'Destination':
+                destinationName = element.attrib['Name']
+        elif element.tag == NS + 'Trip':
+            predictionData['predictions'].append({'minutes': int(element.attrib['ETA']),
+                                                  'destination': destinationName,
+                                                  'route': routeNumber})
+            release(element)
+
+    predictionData['predictions'].sort(key=lambda x: x['minutes'])
+    return predictionData
 
 class Connexionz(object):
-    def __init__(self, baseURL, agency, db, collectionPrefix):
+    def __init__(self, baseURL, agency, db, collectionPrefix, dailyQuota=None, httpOptions=None):
+        self.calls = CallCounter(db[collectionPrefix + "RateLimit"], dailyQuota)
+        self.rs = upstreamSession(self.calls.record, **(httpOptions or {}))
+        self.conditional = ConditionalGet(db)
         self.baseURL = baseURL
         self.agency = agency
         self.stopsCollection = db[collectionPrefix + "Stops"]
         self.routesCollection = db[collectionPrefix + "Routes"]
         self.predictionsCollection = db[collectionPrefix + "Predictions"]
-        self.stopsCollection.create_index([("location", GEO2D)])
+        self.routeStopsCollection = db[collectionPrefix + "RouteStops"]
+        self.refresher = SingleFlight(db)
+        self.stopsGeneration = DataGeneration(db, self.stopsCollection.name)
+        self.routesGeneration = DataGeneration(db, self.routesCollection.name)
+        self.stopCache = LRUCache(generations=[self.stopsGeneration])
+        self.routeCache = LRUCache(generations=[self.routesGeneration])
+        self.routeStopsGeneration = DataGeneration(db, self.routeStopsCollection.name)
+        self.routeStopsCache = LRUCache(generations=[self.routeStopsGeneration])
+        self.static = None
 
 
-    def fetchStops(self):
-        r = requests.get(self.baseURL + "/rtt/public/utility/file.aspx?contenttype=SQLXML&Name=Platform.xml")
-        r.raise_for_status()
-        stopTree = etree.fromstring(r.content)
-
-        for stop in stopTree.xpath('/c:Platforms/c:Platform', namespaces=NSMAP):
-            position = stop.xpath('./c:Position', namespaces=NSMAP)[0]
-            stopData = {'agency': self.agency,
-                        'name': stop.attrib['Name'],
-                        'tag': stop.attrib['PlatformTag'],
-                        'location': [float(position.attrib['Long']), float(position.attrib['Lat'])]}
-            if 'PlatformNo' in stop.attrib:
-                stopData['number'] = stop.attrib['PlatformNo']
-            position = stop.xpath('c:Position', namespaces=NSMAP)[0]
-            self.stopsCollection.update({'agency': self.agency,
-                                         'tag': stop.attrib['PlatformTag']},
-                                        stopData,
-                                        upsert=True)
-        
-
-    def fetchRoutes(self):
-        r = requests.get(self.baseURL + "/rtt/public/utility/file.aspx?contenttype=SQLXML&Name=RoutePattern.rxml")
-        r.raise_for_status()
-        routeTree = etree.fromstring(r.content)
-        for route in routeTree.xpath('/RoutePattern/Project/Route'):
-            routeData = {'agency': self.agency,
-                         'number': route.attrib['RouteNo'],
-                         'name': route.attrib['Name'],
-                         'patterns': {}}
-            for pattern in route.xpath('Destination/Pattern'):
-                if pattern.attrib['Schedule'] != 'Active':
-                    continue
-                patternData = {'destinationName': pattern.xpath('../@Name')[0],
-                               'direction': pattern.attrib['Direction'],
-                               'routeTag': pattern.attrib['RouteTag'],
-                               'name': pattern.attrib['Name'],
-                               'platforms': []}
-
-                for platform in pattern.xpath('Platform'):
-                    tag = platform.attrib['PlatformTag']
-                    patternData['platforms'].append(tag)
-                routeData['patterns'][patternData['routeTag']] = patternData
-            self.routesCollection.update({'agency': self.agency,
-                                          'number': routeData['number']},
-                                         routeData,
-                                         upsert=True)
+    def fetchStops(self, batchSize=500, force=False):
+        r = self.conditional.get(self.rs, self.baseURL + "/rtt/public/utility/file.aspx?contenttype=SQLXML&Name=Platform.xml",
+                                 self.stopsCollection.name, prefetch=False)
+        if r is None:
+            summary = LoadSummary(self.stopsCollection.name)
+            summary.notModified = True
+            return summary
+        stopsOut = parsePlatforms(responseChunks(r), self.agency)
 
-    def fetchPredictions(self, stopTag):
-        r = requests.get(self.baseURL + "/rtt/public/utility/file.aspx?contenttype=SQLXML&Name=RoutePositionET.xml&PlatformTag=" + stopTag)
-        r.raise_for_status()
+        summary = BulkLoader(self.stopsCollection, ['agency', 'tag'],
+                             scope={'agency': self.agency}, batchSize=batchSize, allowEmpty=force).load(stopsOut)
+        if summary.changed():
+            self.stopsGeneration.bump()
+        self.conditional.save(self.stopsCollection.name, r)
+        return summary
 
-        predictionsTree = etree.fromstring(r.content)
+    def fetchRoutes(self, batchSize=500, force=False):
+        r = self.conditional.get(self.rs, self.baseURL + "/rtt/public/utility/file.aspx?contenttype=SQLXML&Name=RoutePattern.rxml",
+                                 self.routesCollection.name, prefetch=False)
+        if r is None:
+            summary = LoadSummary(self.routesCollection.name)
+            summary.notModified = True
+            return summary
+        routesOut = parseRoutePatterns(responseChunks(r), self.agency)
 
-        
-        predictionData = {'agency': self.agency,
-                          'tag': stopTag,
-                          'expires': parse(predictionsTree.xpath('/c:RoutePositionET/c:Content/@Expires',
-                                                                 namespaces=NSMAP)[0], utc=True),
-                          'predictions': []}        
-        
-        for trip in predictionsTree.xpath('/c:RoutePositionET/c:Platform/c:Route/c:Destination/c:Trip',
-                                          namespaces=NSMAP):
-            predictionData['predictions'].append({'minutes': int(trip.attrib['ETA']),
-                                                  'destination': trip.xpath('../@Name')[0],
-                                                  'route': trip.xpath('../../@RouteNo')[0]})
+        summary = BulkLoader(self.routesCollection, ['agency', 'number'],
+                             scope={'agency': self.agency}, batchSize=batchSize, allowEmpty=force).load(routesOut)
+        if summary.changed():
+            self.routesGeneration.bump()
+        self.conditional.save(self.routesCollection.name, r)
+        return summary
 
-        predictionData['predictions'].sort(key=lambda x: x['minutes'])
-        
+    def _routeStopsDocument(self, route, pattern, stops):
+        patternStops = []
+        for stopTag in pattern['platforms']:
+            if stopTag in stops:
+                stop = stops[stopTag]
+                stopData = {'tag': stopTag, 'name': stop['name'], 'location': stop['location']}
+                if 'number' in stop:
+                    stopData['number'] = stop['number']
+                patternStops.append(stopData)
+        return {'agency': self.agency,
+                'number': route['number'],
+                'routeTag': pattern['routeTag'],
+                'name': pattern['name'],
+                'direction': pattern['direction'],
+                'destinationName': pattern['destinationName'],
+                'stops': patternStops}
 
+    def buildRouteStops(self, batchSize=500, force=False):
+        stops = dict((stop['tag'], stop) for stop in self.getAllStops())
+        routeStopsOut = []
+        for route in self.getRoutes():
+            for pattern in route['patterns'].values():
+                missing = [stopTag for stopTag in pattern['platforms'] if stopTag not in stops]
+                if missing:
+                    log.warning("ART pattern %s/%s lists unknown stops %s", route['number'], pattern['routeTag'], missing)
+                routeStopsOut.append(self._routeStopsDocument(route, pattern, stops))
+
+        summary = BulkLoader(self.routeStopsCollection, ['agency', 'number', 'routeTag'],
+                             scope={'agency': self.agency}, batchSize=batchSize, allowEmpty=force).load(routeStopsOut)
+        if summary.changed():
+            self.routeStopsGeneration.bump()
+        return summary
+
+    def fetchPredictions(self, stopTag):
+        r = self.rs.get(self.baseURL + "/rtt/public/utility/file.aspx?contenttype=SQLXML&Name=RoutePositionET.xml&PlatformTag=" + stopTag,
+                         prefetch=False)
+        r.raise_for_status()
+
+        predictionData = parsePredictions(responseChunks(r), self.agency, stopTag)
+        predictionData['fetched'] = datetime.utcnow()
+
+        timeToLive = predictionData['expires'].replace(tzinfo=None) - datetime.utcnow()
+        if timeToLive > timedelta(0):
+            predictionData['expires'] = datetime.utcnow() + self.calls.stretch(timeToLive)
         return predictionData
-        
+
+    def staticTables(self):
+        agency = {"agency": self.agency}
+        return [('connexionzStops/' + self.agency, self.stopsGeneration.current(fresh=True),
+                 self.stopsCollection.find(agency), ['tag', 'number']),
+                ('connexionzRoutes/' + self.agency, self.routesGeneration.current(fresh=True),
+                 self.routesCollection.find(agency), ['number']),
+                ('connexionzRouteStops/' + self.agency, self.routeStopsGeneration.current(fresh=True),
+                 self.routeStopsCollection.find(agency), [('number', 'routeTag')])]
 
     def getRoutes(self):
+        table = staticTable(self.static, 'connexionzRoutes/' + self.agency, self.routesGeneration)
+        if table is not None:
+            return iter(table)
         routes = self.routesCollection.find({"agency": self.agency})
         return routes
     
     def getRoute(self, routeNumber):
-        route = self.routesCollection.find_one({"agency": self.agency,
-                                                "number": routeNumber})
+        table = staticTable(self.static, 'connexionzRoutes/' + self.agency, self.routesGeneration)
+        if table is not None:
+            return table.find('number', routeNumber)
+        route = self.routeCache.get(routeNumber,
+                                    lambda: self.routesCollection.find_one({"agency": self.agency,
+                                                                            "number": routeNumber}))
         return route
 
+    def getRouteStops(self, routeNumber, routeTag):
+        table = staticTable(self.static, 'connexionzRouteStops/' + self.agency, self.routeStopsGeneration)
+        if table is not None:
+            routeStops = table.find(('number', 'routeTag'), (routeNumber, routeTag))
+        else:
+            routeStops = self.routeStopsCache.get((routeNumber, routeTag),
+                                                  lambda: self.routeStopsCollection.find_one({"agency": self.agency,
+                                                                                              "number": routeNumber,
+                                                                                              "routeTag": routeTag}))
+        if routeStops is None:
+            # Not built yet (buildRouteStops runs with load_art).
+            route = self.getRoute(routeNumber)
+            if route is None or routeTag not in route['patterns']:
+                return None
+            pattern = route['patterns'][routeTag]
+            stops = {}
+            for stopTag in pattern['platforms']:
+                stop = self.getStop(stopTag)
+                if stop is not None:
+                    stops[stopTag] = stop
+            routeStops = self._routeStopsDocument(route, pattern, stops)
+        return routeStops
+
     def getStopsNear(self, longitude, latitude):
         return self.stopsCollection.find({'location': {'$nearSphere': [longitude, latitude],
                                                        '$maxDistance': 0.25/3959}})
 
+    def getAllStops(self):
+        table = staticTable(self.static, 'connexionzStops/' + self.agency, self.stopsGeneration)
+        if table is not None:
+            return iter(table)
+        return self.stopsCollection.find({"agency": self.agency},
+                                         fields={'tag': 1, 'name': 1, 'number': 1, 'location': 1})
+
     def getStop(self, stopTag):
-        stop = self.stopsCollection.find_one({"agency": self.agency,
-                                              "tag": stopTag})
+        table = staticTable(self.static, 'connexionzStops/' + self.agency, self.stopsGeneration)
+        if table is not None:
+            return table.find('tag', stopTag)
+        stop = self.stopCache.get(('tag', stopTag),
+                                  lambda: self.stopsCollection.find_one({"agency": self.agency,
+                                                                         "tag": stopTag}))
         return stop
 
     def getStopTag(self, stopID):
-        stop = self.stopsCollection.find_one({"agency": self.agency,
-                                              "number": stopID})
-        return stop['tag']
+        table = staticTable(self.static, 'connexionzStops/' + self.agency, self.stopsGeneration)
+        if table is not None:
+            stop = table.find('number', stopID)
+        else:
+            stop = self.stopCache.get(('number', stopID),
+                                      lambda: self.stopsCollection.find_one({"agency": self.agency,
+                                                                             "number": stopID}))
+        return stop['tag'] if stop is not None else None
+
+    def getPredictionsExpiration(self, stopTag):
+        predictions = self.predictionsCollection.find_one({"agency": self.agency,
+                                                           "tag": stopTag},
+                                                          fields={'expires': 1})
+        return predictions['expires'] if predictions is not None else None
+
+    def _updatePredictions(self, stopTag):
+        predictions = self.fetchPredictions(stopTag)
+        self.predictionsCollection.update({"agency": self.agency,
+                                           "tag": stopTag},
+                                          predictions,
+                                          upsert=True)
 
     def getPredictions(self, stopTag):
         predictions = self.predictionsCollection.find_one({"agency": self.agency,
-                                                           "tag": stopTag,
-                                                           "expires": {"$gte": datetime.utcnow()}})
-        if predictions is None:
-            predictions = self.fetchPredictions(stopTag)
-            self.predictionsCollection.update({"agency": self.agency,
-                                               "tag": stopTag},
-                                              predictions,
-                                              upsert=True)
+                                                           "tag": stopTag})
+        refreshed = self.refresher.revalidate('connexionzPredictions:%s:%s' % (self.agency, stopTag),
+                                              predictions['expires'] if predictions is not None else None,
+                                              freshnessCheck(self.predictionsCollection, {"agency": self.agency,
+                                                                                          "tag": stopTag},
+                                                             field='expires'),
+                                              lambda: self._updatePredictions(stopTag))
+        if refreshed or predictions is None:
+            predictions = self.predictionsCollection.find_one({"agency": self.agency,
+                                                               "tag": stopTag})
 
         return predictions
@@ -0,0 +1,150 @@
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo import ASCENDING, GEO2D
+from pymongo.errors import OperationFailure
+
+def indexSpec(nextbusPrefix='nextbus', connexionzPrefix='art', predictionsTTL=3600, leasesTTL=3600):
+    """The indexes every collection should have, as {collection: [(keys, options)]}."""
+    predictionsTTLOptions = {'expireAfterSeconds': predictionsTTL}
+    return {
+        'wmataStops': [([('location', GEO2D)], {}),
+                       ([('id', ASCENDING)], {})],
+        'wmataStations': [([('location', GEO2D)], {}),
+                          ([('rtus', ASCENDING)], {}),
+                          ([('name', ASCENDING)], {})],
+        'wmataBusPredictions': [([('stopID', ASCENDING)], {}),
+                                ([('expiration', ASCENDING)], predictionsTTLOptions)],
+        'wmataRailPredictions': [([('generation', ASCENDING), ('locationCode', ASCENDING)], {})],
+        'wmataRailIncidents': [([('generation', ASCENDING)], {})],
+        'wmataELESIncidents': [([('generation', ASCENDING), ('unitStatus', ASCENDING),
+                                 ('stationCode', ASCENDING)], {})],
+        'wmataRateLimit': [([('date', ASCENDING)], {})],
+        nextbusPrefix + 'Stops': [([('location', GEO2D)], {}),
+                                  ([('agency', ASCENDING), ('tag', ASCENDING)], {}),
+                                  ([('agency', ASCENDING), ('stopID', ASCENDING)], {})],
+        nextbusPrefix + 'Routes': [([('agency', ASCENDING), ('tag', ASCENDING)], {})],
+        nextbusPrefix + 'RouteStops': [([('agency', ASCENDING), ('tag', ASCENDING), ('direction', ASCENDING)], {})],
+        nextbusPrefix + 'Predictions': [([('agency', ASCENDING), ('stopID', ASCENDING)], {}),
+                                        ([('agency', ASCENDING), ('stopTag', ASCENDING),
+                                          ('routeTag', ASCENDING)], {}),
+                                        ([('expiration', ASCENDING)], predictionsTTLOptions)],
+        nextbusPrefix + 'RateLimit': [([('date', ASCENDING)], {})],
+        connexionzPrefix + 'Stops': [([('location', GEO2D)], {}),
+                                     ([('agency', ASCENDING), ('tag', ASCENDING)], {}),
+                                     ([('agency', ASCENDING), ('number', ASCENDING)], {})],
+        connexionzPrefix + 'Routes': [([('agency', ASCENDING), ('number', ASCENDING)], {})],
+        connexionzPrefix + 'RouteStops': [([('agency', ASCENDING), ('number', ASCENDING),
+                                            ('routeTag', ASCENDING)], {})],
+        connexionzPrefix + 'Predictions': [([('agency', ASCENDING), ('tag', ASCENDING)], {}),
+                                           ([('expires', ASCENDING)], predictionsTTLOptions)],
+        connexionzPrefix + 'RateLimit': [([('date', ASCENDING)], {})],
+        'refreshLeases': [([('expires', ASCENDING)], {'expireAfterSeconds': leasesTTL})],
+        }
+
+def queryShapes(nextbusPrefix='nextbus', connexionzPrefix='art', nextbusAgency='dc-circulator',
+                connexionzAgency='ART'):
+    """Every query the app issues, as (collection, query, sort, scanExpected)."""
+    now = datetime.utcnow()
+    generation = ObjectId()
+    near = {'$nearSphere': [-77.0365, 38.8977], '$maxDistance': 0.25/3959}
+    return [
+        ('wmataStops', {'location': near}, None, False),
+        ('wmataStops', {'id': '1001195'}, None, False),
+        ('wmataStops', {}, None, True),
+        ('wmataStations', {'location': near}, None, False),
+        ('wmataStations', {'rtus': {'$in': ['A01', 'C01']}}, [('name', ASCENDING)], False),
+        ('wmataStations', {}, [('name', ASCENDING)], False),
+        ('wmataBusPredictions', {'stopID': '1001195'}, None, False),
+        ('wmataRailPredictions', {'generation': generation, 'locationCode': {'$in': ['A01', 'C01']}},
+         None, False),
+        ('wmataRailIncidents', {'generation': generation}, None, False),
+        ('wmataELESIncidents', {'generation': generation, 'unitStatus': 'O'}, None, False),
+        ('wmataELESIncidents', {'generation': generation, 'unitStatus': 'O',
+                                'stationCode': {'$in': ['A01', 'C01']}}, [('displayOrder', ASCENDING)], False),
+        ('wmataRateLimit', {'date': str(now.date())}, None, False),
+        (nextbusPrefix + 'Stops', {'location': near}, None, False),
+        (nextbusPrefix + 'Stops', {'agency': nextbusAgency, 'tag': '1234'}, None, False),
+        (nextbusPrefix + 'Stops', {'agency': nextbusAgency, 'stopID': 1234}, None, False),
+        (nextbusPrefix + 'Stops', {'agency': nextbusAgency}, None, True),
+        (nextbusPrefix + 'Routes', {'agency': nextbusAgency}, None, False),
+        (nextbusPrefix + 'Routes', {'agency': nextbusAgency, 'tag': 'yellow'}, None, False),
+        (nextbusPrefix + 'RouteStops', {'agency': nextbusAgency, 'tag': 'yellow', 'direction': 'yellow_0'},
+         None, False),
+        (nextbusPrefix + 'RouteStops', {'agency': nextbusAgency}, None, False),
+        (nextbusPrefix + 'Predictions', {'agency': nextbusAgency, 'stopID': 1234}, None, False),
+        (nextbusPrefix + 'Predictions', {'agency': nextbusAgency, 'stopTag': '1234', 'routeTag': 'yellow'},
+         None, False),
+        (connexionzPrefix + 'Stops', {'location': near}, None, False),
+        (connexionzPrefix + 'Stops', {'agency': connexionzAgency, 'tag': '1234'}, None, False),
+        (connexionzPrefix + 'Stops', {'agency': connexionzAgency, 'number': '41000'}, None, False),
+        (connexionzPrefix + 'Stops', {'agency': connexionzAgency}, None, True),
+        (connexionzPrefix + 'Routes', {'agency': connexionzAgency}, None, False),
+        (connexionzPrefix + 'Routes', {'agency': connexionzAgency, 'number': '41'}, None, False),
+        (connexionzPrefix + 'RouteStops', {'agency': connexionzAgency, 'number': '41', 'routeTag': '41A'},
+         None, False),
+        (connexionzPrefix + 'RouteStops', {'agency': connexionzAgency}, None, False),
+        (connexionzPrefix + 'Predictions', {'agency': connexionzAgency, 'tag': '1234'}, None, False),
+        ('refreshLeases', {'_id': 'wmataRailPredictions', 'expires': {'$gte': now}}, None, False),
+        ]
+
+def ensureIndexes(db, spec):
+    """Create missing indexes and collMod changed TTLs; returns [(collection, keys, action)]."""
+    actions = []
+    for (collectionName, indexes) in sorted(spec.items()):
+        collection = db[collectionName]
+        existing = dict((tuple(tuple(key) for key in info['key']), info)
+                        for info in collection.index_information().values())
+        for (keys, options) in indexes:
+            info = existing.get(tuple(keys))
+            if info is None:
+                collection.create_index(keys, **options)
+                actions.append((collectionName, keys, 'created'))
+            elif info.get('expireAfterSeconds') != options.get('expireAfterSeconds'):
+                db.command('collMod', collectionName,
+                           index={'keyPattern': SON(keys),
+                                  'expireAfterSeconds': options.get('expireAfterSeconds')})
+                actions.append((collectionName, keys, 'updated'))
+            else:
+                actions.append((collectionName, keys, 'present'))
+    return actions
+
+def _planStages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            for stage in _planStages(value):
+                yield stage
+    elif isinstance(plan, list):
+        for value in plan:
+            for stage in _planStages(value):
+                yield stage
+
+def isCollectionScan(explanation):
+    """Whether a 2.x or 3.x explain() result reads the whole collection."""
+    if 'queryPlanner' in explanation:
+        return 'COLLSCAN' in set(_planStages(explanation['queryPlanner']['winningPlan']))
+    return explanation.get('cursor', '').startswith('BasicCursor')
+
+def auditQueries(db, shapes):
+    """explain() every query shape; returns [(collection, query, status)]."""
+    results = []
+    for (collectionName, query, sort, scan) in shapes:
+        cursor = db[collectionName].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            collectionScan = isCollectionScan(cursor.explain())
+        except OperationFailure, e:
+            results.append((collectionName, query, 'error: %s' % e))
+            continue
+        if not collectionScan:
+            status = 'index'
+        elif scan:
+            status = 'expected scan'
+        else:
+            status = 'scan'
+        results.append((collectionName, query, status))
+    return results
@@ -0,0 +1,46 @@
+import json
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from flask import Response, request
+
+INTERNAL_FIELDS = ('_id', 'contentHash', 'generation')
+
+def toJSON(value):
+    if isinstance(value, dict):
+        return dict((key, toJSON(item)) for key, item in value.items()
+                    if key not in INTERNAL_FIELDS)
+    if isinstance(value, (list, tuple)):
+        return [toJSON(item) for item in value]
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None).isoformat() + 'Z'
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+def secondsUntil(expiration):
+    if expiration is None:
+        return 0
+    return max(0, int((expiration.replace(tzinfo=None) - datetime.utcnow()).total_seconds()))
+
+def staleAge(expiration, fetched=None):
+    """Seconds since expired data was fetched, or None while it is fresh."""
+    if expiration is None:
+        return None
+    now = datetime.utcnow()
+    if expiration.replace(tzinfo=None) >= now:
+        return None
+    since = fetched if fetched is not None else expiration
+    return int((now - since.replace(tzinfo=None)).total_seconds())
+
+def cachedJSON(etag, maxAge, build):
+    """JSON with an ETag and max-age, or a 304 without calling build()."""
+    if etag is not None and etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(json.dumps(toJSON(build())), mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = maxAge
+    return response
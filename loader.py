@@ -0,0 +1,100 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import pymongo
+
+# initialize_unordered_bulk_op is new in pymongo 2.7.
+PYMONGO_MINIMUM = (2, 7)
+if tuple(pymongo.version_tuple[:2]) < PYMONGO_MINIMUM:
+    raise ImportError("loader needs pymongo >= %d.%d, found %s" % (PYMONGO_MINIMUM + (pymongo.version,)))
+
+def contentHash(document):
+    content = dict((key, value) for key, value in document.items()
+                   if key not in ('_id', 'contentHash'))
+    return hashlib.md5(json.dumps(content, sort_keys=True, default=str)).hexdigest()
+
+class LoadSummary(object):
+    def __init__(self, name):
+        self.name = name
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.seconds = 0.0
+        self.notModified = False
+
+    def changed(self):
+        return (self.inserted + self.updated + self.deleted) > 0
+
+    def __str__(self):
+        if self.notModified:
+            return "%s: not modified upstream" % self.name
+        return "%s: %d inserted, %d updated, %d unchanged, %d deleted in %.2fs" % \
+            (self.name, self.inserted, self.updated, self.unchanged, self.deleted, self.seconds)
+
+class BulkLoader(object):
+    """Sync a static collection (or its scope) with documents, writing only changes."""
+
+    def __init__(self, collection, keyFields, scope=None, batchSize=500, allowEmpty=False):
+        self.collection = collection
+        self.keyFields = keyFields
+        self.scope = scope or {}
+        self.batchSize = batchSize
+        self.allowEmpty = allowEmpty
+
+    def _key(self, document):
+        return tuple(document.get(field) for field in self.keyFields)
+
+    def load(self, documents):
+        start = time.time()
+        summary = LoadSummary(self.collection.name)
+
+        existing = {}
+        for document in self.collection.find(self.scope, fields=list(self.keyFields) + ['contentHash']):
+            existing[self._key(document)] = (document['_id'], document.get('contentHash'))
+
+        incoming = OrderedDict()
+        for document in documents:
+            incoming[self._key(document)] = document
+        if not incoming and existing and not self.allowEmpty:
+            raise ValueError("Refusing to delete all %d documents of %s with an empty load" %
+                             (len(existing), self.collection.name))
+
+        inserts = []
+        updates = None
+        pendingUpdates = 0
+        for key, document in incoming.items():
+            document['contentHash'] = contentHash(document)
+            if key not in existing:
+                inserts.append(document)
+                summary.inserted += 1
+                if len(inserts) >= self.batchSize:
+                    self.collection.insert(inserts)
+                    inserts = []
+            elif existing[key][1] == document['contentHash']:
+                summary.unchanged += 1
+            else:
+                if updates is None:
+                    updates = self.collection.initialize_unordered_bulk_op()
+                updates.find({'_id': existing[key][0]}).replace_one(document)
+                pendingUpdates += 1
+                summary.updated += 1
+                if pendingUpdates >= self.batchSize:
+                    updates.execute()
+                    updates = None
+                    pendingUpdates = 0
+
+        if inserts:
+            self.collection.insert(inserts)
+        if updates is not None:
+            updates.execute()
+
+        stale = [existing[key][0] for key in existing if key not in incoming]
+        for i in range(0, len(stale), self.batchSize):
+            self.collection.remove({'_id': {'$in': stale[i:i + self.batchSize]}})
+        summary.deleted = len(stale)
+
+        summary.seconds = time.time() - start
+        return summary
@@ -1,43 +1,77 @@
+import logging
+import sys
+
 from flaskext.script import Manager
-from pymongo import Connection
 
-from app import app
-from wmata import WMATA
-from nextbus import NextBus
-from connexionz import Connexionz
+from app import app, services
+from poller import FeedPoller, wmataFeeds
+from indexes import auditQueries, ensureIndexes, indexSpec, queryShapes
+from staticdata import writeStaticSnapshot
 
 manager = Manager(app)
 
 @manager.command
-def load_wmata():
-    app.config.from_envvar('CTI_SETTINGS')
-    connection = Connection()
-    db = connection[app.config['DB_NAME']]
-    wmata = WMATA(app.config['WMATA_KEY'], db)
-    wmata.fetchStops()
-    print "Loaded WMATA stops"
-    wmata.fetchStations()
-    print "Loaded WMATA stations"
+def load_wmata(force=False):
+    wmata = services.get().wmata
+    batchSize = app.config.get('LOADER_BATCH_SIZE', 500)
+    print wmata.fetchStops(batchSize=batchSize, force=force)
+    print wmata.fetchStations(batchSize=batchSize, force=force)
+
+@manager.command
+def load_circulator(force=False):
+    circulator = services.get().circulator
+    (routeSummary, stopSummary) = circulator.loadAgencyData(batchSize=app.config.get('LOADER_BATCH_SIZE', 500),
+                                                            workers=app.config.get('NEXTBUS_LOAD_WORKERS', 4),
+                                                            requestsPerSecond=app.config.get('NEXTBUS_REQUESTS_PER_SECOND', 2),
+                                                            allRoutes=app.config.get('NEXTBUS_LOAD_ALL_ROUTES', False),
+                                                            force=force)
+    print routeSummary
+    print stopSummary
+    print circulator.buildRouteStops(batchSize=app.config.get('LOADER_BATCH_SIZE', 500), force=force)
+
+@manager.command
+def load_art(force=False):
+    art = services.get().art
+    batchSize = app.config.get('LOADER_BATCH_SIZE', 500)
+    print art.fetchStops(batchSize=batchSize, force=force)
+    print art.fetchRoutes(batchSize=batchSize, force=force)
+    print art.buildRouteStops(batchSize=batchSize, force=force)
+
+@manager.command
+def ensure_indexes(audit=False):
+    """Create missing indexes; --audit fails on collection scans."""
+    db = services.get().db
+    spec = indexSpec(predictionsTTL=app.config.get('PREDICTIONS_TTL', 3600))
+    for (collectionName, keys, action) in ensureIndexes(db, spec):
+        print "%-9s %s %s" % (action, collectionName, keys)
+    if audit:
+        scans = 0
+        for (collectionName, query, status) in auditQueries(db, queryShapes()):
+            print "%-13s %s %s" % (status, collectionName, query)
+            if status != 'index' and status != 'expected scan':
+                scans += 1
+        if scans:
+            print "%d queries without a usable index" % scans
+            sys.exit(1)
 
 @manager.command
-def load_circulator():
-    app.config.from_envvar('CTI_SETTINGS')
-    connection = Connection()
-    db = connection[app.config['DB_NAME']]
-    circulator = NextBus("dc-circulator", db, 'nextbus')
-    circulator.loadAgencyData()
-    print "Loaded Circulator stops and routes"
+def compile_static(path=None):
+    """Write static data to the STATIC_SNAPSHOT file."""
+    path = path or app.config['STATIC_SNAPSHOT']
+    tables = []
+    for (upstream, client) in services.get().clients:
+        tables.extend(client.staticTables())
+    header = writeStaticSnapshot(path, tables)
+    for (name, table) in sorted(header['tables'].items()):
+        print "%-32s %6d records at generation %d" % (name, table['count'], table['generation'])
+    print "Wrote %d bytes to %s" % (header['bytes'], path)
 
 @manager.command
-def load_art():
-    app.config.from_envvar('CTI_SETTINGS')
-    connection = Connection()
-    db = connection[app.config['DB_NAME']]
-    art = Connexionz("http://realtime.commuterpage.com", "ART", db, 'art')
-    art.fetchStops()
-    print "Loaded ART stops"
-    art.fetchRoutes()
-    print "Loaded ART routes"
+def poll():
+    poller = FeedPoller(services.get().db, wmataFeeds(services.get().wmata))
+    logging.basicConfig(level=logging.INFO)
+    print "Polling WMATA feeds"
+    poller.run()
 
 if __name__ == "__main__":
     manager.run()
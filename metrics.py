@@ -0,0 +1,227 @@
+import functools
+import threading
+import time
+import types
+from bisect import bisect_left
+
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def formatLabels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                .replace('\n', '\\n'))
+                             for (name, value) in pairs)
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labelValues=(), amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for (labelValues, value) in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, formatLabels(self.labels, labelValues), formatValue(value)))
+        return lines
+
+class Histogram(object):
+    """Cumulative bucket counts, a sum and a count per label set."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, labelValues=()):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.values.get(labelValues)
+            if series is None:
+                series = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for (labelValues, (counts, total)) in sorted(self.values.items()):
+                cumulative = 0
+                for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (self.name,
+                                                      formatLabels(self.labels, labelValues,
+                                                                   [('le', formatValue(bound))]),
+                                                      cumulative))
+                lines.append('%s_sum%s %s' % (self.name, formatLabels(self.labels, labelValues), repr(total)))
+                lines.append('%s_count%s %d' % (self.name, formatLabels(self.labels, labelValues), cumulative))
+        return lines
+
+class Gauges(object):
+    """Values read from collect() at scrape time."""
+
+    def __init__(self, name, help, labels, collect, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.type = type
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for (labelValues, value) in sorted(self.collect()):
+            lines.append('%s%s %s' % (self.name, formatLabels(self.labels, labelValues), formatValue(value)))
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+viewSeconds = registry.add(Histogram('cti_view_seconds', 'Time spent in each Flask view.',
+                                     ('endpoint', 'status')))
+upstreamRequestSeconds = registry.add(Histogram('cti_upstream_request_seconds',
+                                                'Time until an upstream API answered, by HTTP status.',
+                                                ('upstream', 'status')))
+upstreamFetchSeconds = registry.add(Histogram('cti_upstream_fetch_seconds',
+                                              'Time spent in each fetch method, request and parsing included.',
+                                              ('upstream', 'fetch')))
+upstreamParseSeconds = registry.add(Histogram('cti_upstream_parse_seconds',
+                                              'Time spent in each fetch method outside of upstream requests.',
+                                              ('upstream', 'fetch')))
+upstreamFailures = registry.add(Counter('cti_upstream_failures_total',
+                                        'Fetch methods that raised, by exception type.',
+                                        ('upstream', 'fetch', 'error')))
+mongoSeconds = registry.add(Histogram('cti_mongo_seconds', 'Time spent in Mongo operations.',
+                                      ('collection', 'operation')))
+
+_local = threading.local()
+
+def instrumentSession(session, upstream):
+    """Time every request made through a requests session."""
+    request = session.request
+
+    @functools.wraps(request)
+    def timedRequest(*args, **kwargs):
+        start = time.time()
+        status = 'error'
+        try:
+            response = request(*args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            elapsed = time.time() - start
+            _local.requestSeconds = getattr(_local, 'requestSeconds', 0.0) + elapsed
+            upstreamRequestSeconds.observe(elapsed, (upstream, status))
+    session.request = timedRequest
+
+def _timedFetch(method, upstream, name):
+    labels = (upstream, name)
+
+    def finish(start, requestStart):
+        elapsed = time.time() - start
+        upstreamFetchSeconds.observe(elapsed, labels)
+        requestSeconds = getattr(_local, 'requestSeconds', 0.0) - requestStart
+        if requestSeconds > 0:
+            upstreamParseSeconds.observe(max(0.0, elapsed - requestSeconds), labels)
+
+    def fail(e):
+        upstreamFailures.inc(labels + (type(e).__name__,))
+
+    def timedGenerator(generator, start, requestStart):
+        try:
+            for item in generator:
+                yield item
+        except Exception, e:
+            fail(e)
+            raise
+        finally:
+            finish(start, requestStart)
+
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        start = time.time()
+        requestStart = getattr(_local, 'requestSeconds', 0.0)
+        try:
+            result = method(*args, **kwargs)
+        except Exception, e:
+            fail(e)
+            finish(start, requestStart)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return timedGenerator(result, start, requestStart)
+        finish(start, requestStart)
+        return result
+    return timed
+
+def instrumentClient(client, upstream):
+    """Time client.rs and every fetch* method of an agency client."""
+    instrumentSession(client.rs, upstream)
+    for name in dir(client):
+        if name.startswith('fetch') and callable(getattr(client, name)):
+            setattr(client, name, _timedFetch(getattr(client, name), upstream, name))
+
+def _timedMongo(method, operation, collectionName):
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            mongoSeconds.observe(time.time() - start, (collectionName(self), operation))
+    return timed
+
+_mongoInstrumented = []
+
+def instrumentMongo():
+    """Time pymongo round trips process-wide."""
+    if _mongoInstrumented:
+        return
+    _mongoInstrumented.append(True)
+    for operation in ('insert', 'update', 'remove', 'find_and_modify'):
+        setattr(Collection, operation, _timedMongo(getattr(Collection, operation), operation,
+                                                   lambda collection: collection.name))
+    Cursor._refresh = _timedMongo(Cursor._refresh, 'find', lambda cursor: cursor.collection.name)
+    Cursor.count = _timedMongo(Cursor.count, 'count', lambda cursor: cursor.collection.name)
+    Cursor.distinct = _timedMongo(Cursor.distinct, 'distinct', lambda cursor: cursor.collection.name)
+
+def statsGauges(name, help, labels, sources, type='gauge'):
+    """Export getStats() dicts as labelled gauges."""
+    def collect():
+        samples = []
+        for (source, stats) in sources().items():
+            for (stat, value) in stats.items():
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    samples.append(((source, stat), value))
+        return samples
+    return registry.add(Gauges(name, help, labels + ('stat',), collect, type))
@@ -1,24 +1,98 @@
-import requests
+import logging
+from collections import OrderedDict
+
 from lxml import etree
-from pymongo import Connection, GEO2D
+from pymongo import Connection
 
 from datetime import datetime, timedelta
 
 from pprint import pprint
 
+from cache import DataGeneration, LRUCache
+from coalesce import SingleFlight, freshnessCheck
+from loader import BulkLoader
+from quota import CallCounter
+from staticdata import staticTable
+from upstream import upstreamSession
+from workers import RateLimiter, parallelMap
+from xmlstream import iterElements, release, responseChunks
+
+log = logging.getLogger(__name__)
+
+def parsePredictions(chunks):
+    routeTitle = None
+    directionTitle = None
+    for event, element in iterElements(chunks, tags=['predictions', 'direction', 'prediction'],
+                                       events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'predictions':
+                routeTitle = element.attrib.get('routeTitle')
+            elif element.tag == 'direction':
+                directionTitle = element.attrib['title']
+        elif element.tag == 'prediction':
+            yield {'minutes': int(element.attrib['minutes']),
+                   'direction': directionTitle,
+                   'route': routeTitle}
+            release(element)
+
+def parseRoute(route, agencyID):
+    routeData = {
+        'agency': agencyID,
+        'tag': route.attrib['tag'],
+        'title': route.attrib.get('shortTitle', route.attrib.get('title')),
+        'directions': {}
+        }
+
+    stops = []
+
+    for child in route.iterchildren('stop', 'direction'):
+        if child.tag == 'stop':
+            stopData = {
+                'agency': agencyID,
+                'tag': child.attrib['tag'],
+                'title': child.attrib.get('shortTitle', child.attrib.get('title')),
+                'location': [float(child.attrib['lon']), float(child.attrib['lat'])]
+                }
+            if 'stopId' in child.attrib:
+                stopData['stopID'] = int(child.attrib['stopId'])
+            stops.append(stopData)
+        elif child.attrib.get('useForUI') == 'true':
+            directionTag = child.attrib['tag']
+            routeData['directions'][directionTag] = {'tag': directionTag,
+                                                     'title': child.attrib['title'],
+                                                     'stops': [stop.attrib['tag'] for stop in child.iterchildren('stop')]}
+
+    return (routeData, stops)
+
+def parseRouteConfigs(chunks, agencyID):
+    for event, route in iterElements(chunks, tags=['route']):
+        parsed = parseRoute(route, agencyID)
+        release(route)
+        yield parsed
+
 class NextBus(object):
 
-    def __init__(self, agencyID, db, collectionPrefix):
-        self.rs = requests.session()
+    def __init__(self, agencyID, db, collectionPrefix, dailyQuota=None, httpOptions=None, baseURL=None):
+        self.baseURL = baseURL or "http://webservices.nextbus.com"
+        self.calls = CallCounter(db[collectionPrefix + "RateLimit"], dailyQuota)
+        self.rs = upstreamSession(self.calls.record, **(httpOptions or {}))
         self.agencyID = agencyID
         self.stopsCollection = db[collectionPrefix + "Stops"]
         self.routesCollection = db[collectionPrefix + "Routes"]
         self.predictionsCollection = db[collectionPrefix + "Predictions"]
-        self.stopsCollection.create_index([("location", GEO2D)])
+        self.routeStopsCollection = db[collectionPrefix + "RouteStops"]
+        self.refresher = SingleFlight(db)
+        self.stopsGeneration = DataGeneration(db, self.stopsCollection.name)
+        self.routesGeneration = DataGeneration(db, self.routesCollection.name)
+        self.stopCache = LRUCache(generations=[self.stopsGeneration])
+        self.routeCache = LRUCache(generations=[self.routesGeneration])
+        self.routeStopsGeneration = DataGeneration(db, self.routeStopsCollection.name)
+        self.routeStopsCache = LRUCache(generations=[self.routeStopsGeneration])
+        self.static = None
 
         
     def fetchRoutesForAgency(self):
-        r = self.rs.get('http://webservices.nextbus.com/service/publicXMLFeed?command=routeList&a=' + \
+        r = self.rs.get(self.baseURL + '/service/publicXMLFeed?command=routeList&a=' + \
                          self.agencyID)
         r.raise_for_status()
         routesTree = etree.fromstring(r.content)
@@ -26,21 +100,19 @@ class NextBus(object):
         return routeTags
 
     def fetchPredictionsByID(self, stopID):
-        r = self.rs.get('http://webservices.nextbus.com/service/publicXMLFeed?command=predictions&a=' + \
-                        self.agencyID + '&stopId=' + str(stopID) + '&useShortTitles=true')
+        r = self.rs.get(self.baseURL + '/service/publicXMLFeed?command=predictions&a=' + \
+                        self.agencyID + '&stopId=' + str(stopID) + '&useShortTitles=true', prefetch=False)
         r.raise_for_status()
-        stopTree = etree.fromstring(r.content)
 
-        expirationTime = datetime.utcnow() + timedelta(minutes=1)
+        fetched = datetime.utcnow()
+        expirationTime = fetched + self.calls.stretch(timedelta(minutes=1))
         predictionsOut = []
 
-        for prediction in stopTree.xpath("/body/predictions/direction/prediction"):
-            predictionData = {'agency': self.agencyID,
-                              'stopID': stopID,
-                              'minutes': int(prediction.attrib['minutes']),
-                              'direction': prediction.getparent().attrib['title'],
-                              'route': prediction.getparent().getparent().attrib['routeTitle'],
-                              'expiration': expirationTime}
+        for predictionData in parsePredictions(responseChunks(r)):
+            predictionData.update({'agency': self.agencyID,
+                                   'stopID': stopID,
+                                   'fetched': fetched,
+                                   'expiration': expirationTime})
             predictionsOut.append(predictionData)
 
         self.predictionsCollection.remove({'agency': self.agencyID,
@@ -49,22 +121,20 @@ class NextBus(object):
             self.predictionsCollection.insert(predictionsOut)
 
     def fetchPredictionsByTag(self, stopTag, routeTag):
-        r = self.rs.get('http://webservices.nextbus.com/service/publicXMLFeed?command=predictions&a=' + \
-                         self.agencyID + '&r=' + routeTag + '&s=' + stopTag + '&useShortTitles=true')
+        r = self.rs.get(self.baseURL + '/service/publicXMLFeed?command=predictions&a=' + \
+                         self.agencyID + '&r=' + routeTag + '&s=' + stopTag + '&useShortTitles=true', prefetch=False)
         r.raise_for_status()
-        stopTree = etree.fromstring(r.content)
 
-        expirationTime = datetime.utcnow() + timedelta(minutes=1)
+        fetched = datetime.utcnow()
+        expirationTime = fetched + self.calls.stretch(timedelta(minutes=1))
         predictionsOut = []
 
-        for prediction in stopTree.xpath("/body/predictions/direction/prediction"):
-            predictionData = {'agency': self.agencyID,
-                              'stopTag': stopTag,
-                              'routeTag': routeTag,
-                              'minutes': int(prediction.attrib['minutes']),
-                              'direction': prediction.getparent().attrib['title'],
-                              'route': prediction.getparent().getparent().attrib['routeTitle'],
-                              'expiration': expirationTime}
+        for predictionData in parsePredictions(responseChunks(r)):
+            predictionData.update({'agency': self.agencyID,
+                                   'stopTag': stopTag,
+                                   'routeTag': routeTag,
+                                   'fetched': fetched,
+                                   'expiration': expirationTime})
             predictionsOut.append(predictionData)
 
         self.predictionsCollection.remove({'agency': self.agencyID,
@@ -74,112 +144,199 @@ class NextBus(object):
             self.predictionsCollection.insert(predictionsOut)
     
     def fetchStopsForRoute(self, routeTag):
-        r = self.rs.get('http://webservices.nextbus.com/service/publicXMLFeed?command=routeConfig&a=' + \
-                         self.agencyID + '&r=' + routeTag + '&terse')
+        r = self.rs.get(self.baseURL + '/service/publicXMLFeed?command=routeConfig&a=' + \
+                         self.agencyID + '&r=' + routeTag + '&terse', prefetch=False)
         r.raise_for_status()
-        routeTree = etree.fromstring(r.content)
-        
-        routes = routeTree.xpath("/body/route[@tag = '" + routeTag + "']")
-        assert len(routes) == 1
-        route = routes[0]
 
-        routeData = {
-            'agency': self.agencyID,
-            'tag': route.attrib['tag'],
-            'directions': {}
-            }
+        routes = [route for route in parseRouteConfigs(responseChunks(r), self.agencyID)
+                  if route[0]['tag'] == routeTag]
+        assert len(routes) == 1
+        return routes[0]
 
-        if 'shortTitle' in route.attrib:
-            routeData['title'] = route.attrib['shortTitle']
-        else:
-            routeData['title'] = route.attrib['title']
+    def fetchAllRouteConfigs(self):
+        r = self.rs.get(self.baseURL + '/service/publicXMLFeed?command=routeConfig&a=' + \
+                         self.agencyID + '&terse', prefetch=False)
+        r.raise_for_status()
 
-        for direction in route.xpath("./direction[@useForUI='true']"):
-            directionTag = direction.attrib['tag']
-            directionTitle = direction.attrib['title']
-            stopTags = [stop.attrib['tag'] for stop in direction.xpath("./stop")]
-            routeData['directions'][directionTag] = {'tag': directionTag,
-                                                     'title': directionTitle,
-                                                     'stops': stopTags}
+        return parseRouteConfigs(responseChunks(r), self.agencyID)
 
-        stops = []
+    def fetchAgencyRoutes(self, workers=4, requestsPerSecond=None, allRoutes=False):
+        if allRoutes:
+            return self.fetchAllRouteConfigs()
 
-        for stop in route.xpath("./stop"):
-            stopData = {
-                'agency': self.agencyID,
-                'tag': stop.attrib['tag'],
-                'location': [float(stop.attrib['lon']), float(stop.attrib['lat'])]
-                }
-            if 'shortTitle' in stop.attrib:
-                stopData['title'] = stop.attrib['shortTitle']
-            else:
-                stopData['title'] = stop.attrib['title']
-            
-            if 'stopId' in stop.attrib:
-                stopData['stopID'] = int(stop.attrib['stopId'])
-            stops.append(stopData)
+        limiter = RateLimiter(requestsPerSecond)
+        def fetchRoute(routeTag):
+            limiter.wait()
+            return self.fetchStopsForRoute(routeTag)
 
-        return (routeData, stops)
+        limiter.wait()
+        return parallelMap(fetchRoute, self.fetchRoutesForAgency(), workers=workers)
             
-    def loadAgencyData(self):
-        routes = self.fetchRoutesForAgency()
-        for routeTag in routes:
-            (routeData, stops) = self.fetchStopsForRoute(routeTag)
-            self.routesCollection.update({'agency': routeData['agency'],
-                                          'tag': routeData['tag']},
-                                         routeData,
-                                         upsert=True)
+    def loadAgencyData(self, batchSize=500, workers=4, requestsPerSecond=None, allRoutes=False, force=False):
+        routesOut = []
+        stopsOut = OrderedDict()
+        for (routeData, stops) in self.fetchAgencyRoutes(workers, requestsPerSecond, allRoutes):
+            routeTag = routeData['tag']
+            routesOut.append(routeData)
             for stop in stops:
-                self.stopsCollection.update({'agency': stop['agency'],
-                                             'tag': stop['tag']},
-                                            stop,
-                                            upsert=True)
-                self.stopsCollection.update({'agency': stop['agency'],
-                                             'tag': stop['tag']},
-                                            {"$addToSet": {'routes': routeTag}})
+                if stop['tag'] not in stopsOut:
+                    stop['routes'] = []
+                    stopsOut[stop['tag']] = stop
+                if routeTag not in stopsOut[stop['tag']]['routes']:
+                    stopsOut[stop['tag']]['routes'].append(routeTag)
+
+        routeSummary = BulkLoader(self.routesCollection, ['agency', 'tag'],
+                                  scope={'agency': self.agencyID},
+                                  batchSize=batchSize, allowEmpty=force).load(routesOut)
+        stopSummary = BulkLoader(self.stopsCollection, ['agency', 'tag'],
+                                 scope={'agency': self.agencyID},
+                                 batchSize=batchSize, allowEmpty=force).load(stopsOut.values())
+
+        if routeSummary.changed():
+            self.routesGeneration.bump()
+        if stopSummary.changed():
+            self.stopsGeneration.bump()
+        return (routeSummary, stopSummary)
+
+    def _routeStopsDocument(self, route, direction, stops):
+        directionStops = []
+        for stopTag in direction['stops']:
+            if stopTag in stops:
+                stop = stops[stopTag]
+                stopData = {'tag': stopTag, 'title': stop['title'], 'location': stop['location']}
+                if 'stopID' in stop:
+                    stopData['stopID'] = stop['stopID']
+                directionStops.append(stopData)
+        return {'agency': self.agencyID,
+                'tag': route['tag'],
+                'title': route['title'],
+                'direction': direction['tag'],
+                'directionTitle': direction['title'],
+                'stops': directionStops}
+
+    def buildRouteStops(self, batchSize=500, force=False):
+        stops = dict((stop['tag'], stop) for stop in self.getAllStops())
+        routeStopsOut = []
+        for route in self.getRoutes():
+            for direction in route['directions'].values():
+                missing = [stopTag for stopTag in direction['stops'] if stopTag not in stops]
+                if missing:
+                    log.warning("Circulator route %s/%s lists unknown stops %s", route['tag'], direction['tag'], missing)
+                routeStopsOut.append(self._routeStopsDocument(route, direction, stops))
+
+        summary = BulkLoader(self.routeStopsCollection, ['agency', 'tag', 'direction'],
+                             scope={'agency': self.agencyID}, batchSize=batchSize, allowEmpty=force).load(routeStopsOut)
+        if summary.changed():
+            self.routeStopsGeneration.bump()
+        return summary
+
+    def staticTables(self):
+        agency = {"agency": self.agencyID}
+        return [('nextbusStops/' + self.agencyID, self.stopsGeneration.current(fresh=True),
+                 self.stopsCollection.find(agency), ['tag', 'stopID']),
+                ('nextbusRoutes/' + self.agencyID, self.routesGeneration.current(fresh=True),
+                 self.routesCollection.find(agency), ['tag']),
+                ('nextbusRouteStops/' + self.agencyID, self.routeStopsGeneration.current(fresh=True),
+                 self.routeStopsCollection.find(agency), [('tag', 'direction')])]
 
     def getRoutes(self):
+        table = staticTable(self.static, 'nextbusRoutes/' + self.agencyID, self.routesGeneration)
+        if table is not None:
+            return iter(table)
         routes = self.routesCollection.find({"agency": self.agencyID})
         return routes
 
     def getRoute(self, routeTag):
-        route = self.routesCollection.find_one({"agency": self.agencyID,
-                                                "tag": routeTag})
+        table = staticTable(self.static, 'nextbusRoutes/' + self.agencyID, self.routesGeneration)
+        if table is not None:
+            return table.find('tag', routeTag)
+        route = self.routeCache.get(routeTag,
+                                    lambda: self.routesCollection.find_one({"agency": self.agencyID,
+                                                                            "tag": routeTag}))
         return route
 
+    def getRouteStops(self, routeTag, directionTag):
+        table = staticTable(self.static, 'nextbusRouteStops/' + self.agencyID, self.routeStopsGeneration)
+        if table is not None:
+            routeStops = table.find(('tag', 'direction'), (routeTag, directionTag))
+        else:
+            routeStops = self.routeStopsCache.get((routeTag, directionTag),
+                                                  lambda: self.routeStopsCollection.find_one({"agency": self.agencyID,
+                                                                                              "tag": routeTag,
+                                                                                              "direction": directionTag}))
+        if routeStops is None:
+            # Not built yet (buildRouteStops runs with load_circulator).
+            route = self.getRoute(routeTag)
+            if route is None or directionTag not in route['directions']:
+                return None
+            direction = route['directions'][directionTag]
+            stops = {}
+            for stopTag in direction['stops']:
+                stop = self.getStopByTag(stopTag)
+                if stop is not None:
+                    stops[stopTag] = stop
+            routeStops = self._routeStopsDocument(route, direction, stops)
+        return routeStops
+
     def getStopsNear(self, longitude, latitude):
         return self.stopsCollection.find({'location': {'$nearSphere': [longitude, latitude],
                                                        '$maxDistance': 0.25/3959}})
     
+    def getAllStops(self):
+        table = staticTable(self.static, 'nextbusStops/' + self.agencyID, self.stopsGeneration)
+        if table is not None:
+            return iter(table)
+        return self.stopsCollection.find({"agency": self.agencyID},
+                                         fields={'tag': 1, 'title': 1, 'stopID': 1, 'location': 1, 'routes': 1})
+
     def getStopByTag(self, stopTag):
-        stop = self.stopsCollection.find_one({"agency": self.agencyID,
-                                              "tag": stopTag})
+        table = staticTable(self.static, 'nextbusStops/' + self.agencyID, self.stopsGeneration)
+        if table is not None:
+            return table.find('tag', stopTag)
+        stop = self.stopCache.get(('tag', stopTag),
+                                  lambda: self.stopsCollection.find_one({"agency": self.agencyID,
+                                                                         "tag": stopTag}))
         return stop
 
     def getStopByID(self, stopID):
-        stop = self.stopsCollection.find_one({"agency": self.agencyID,
-                                              "stopID": stopID})
+        table = staticTable(self.static, 'nextbusStops/' + self.agencyID, self.stopsGeneration)
+        if table is not None:
+            return table.find('stopID', stopID)
+        stop = self.stopCache.get(('stopID', stopID),
+                                  lambda: self.stopsCollection.find_one({"agency": self.agencyID,
+                                                                         "stopID": stopID}))
         return stop
 
-    def getPredictionsByID(self, stopID):
+    def getPredictionsExpirationByID(self, stopID):
         expiration = self.predictionsCollection.find_one({"agency": self.agencyID,
                                                           'stopID': stopID},
-                                                         fields={'expiration': '1'})
-        
-        if expiration is None or expiration['expiration'] < datetime.utcnow():
-            self.fetchPredictionsByID(stopID)
+                                                         fields={'expiration': 1})
+        return expiration['expiration'] if expiration is not None else None
+
+    def getPredictionsExpirationByTag(self, stopTag, routeTag):
+        expiration = self.predictionsCollection.find_one({"agency": self.agencyID,
+                                                          'stopTag': stopTag,
+                                                          'routeTag': routeTag},
+                                                         fields={'expiration': 1})
+        return expiration['expiration'] if expiration is not None else None
+
+    def getPredictionsByID(self, stopID):
+        self.refresher.revalidate('nextbusPredictions:%s:id:%s' % (self.agencyID, stopID),
+                                  self.getPredictionsExpirationByID(stopID),
+                                  freshnessCheck(self.predictionsCollection, {"agency": self.agencyID,
+                                                                              'stopID': stopID}),
+                                  lambda: self.fetchPredictionsByID(stopID))
 
         return self.predictionsCollection.find({"agency": self.agencyID,
                                                 'stopID': stopID})
 
     def getPredictionsByTag(self, stopTag, routeTag):
-        expiration = self.predictionsCollection.find_one({"agency": self.agencyID,
-                                                          'stopTag': stopTag,
-                                                          'routeTag': routeTag},
-                                                         fields={'expiration': '1'})
-        
-        if expiration is None or expiration['expiration'] < datetime.utcnow():
-            self.fetchPredictionsByTag(stopTag, routeTag)
+        self.refresher.revalidate('nextbusPredictions:%s:tag:%s:%s' % (self.agencyID, stopTag, routeTag),
+                                  self.getPredictionsExpirationByTag(stopTag, routeTag),
+                                  freshnessCheck(self.predictionsCollection, {"agency": self.agencyID,
+                                                                              'stopTag': stopTag,
+                                                                              'routeTag': routeTag}),
+                                  lambda: self.fetchPredictionsByTag(stopTag, routeTag))
 
         return self.predictionsCollection.find({"agency": self.agencyID,
                                                 'stopTag': stopTag,
@@ -0,0 +1,104 @@
+import logging
+import random
+import time
+import traceback
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+class Feed(object):
+    def __init__(self, name, interval, fetch, jitter=0.1, maxBackoff=600, stretch=None):
+        self.name = name
+        self.interval = interval
+        self.stretch = stretch
+        self.fetch = fetch
+        self.jitter = jitter
+        self.maxBackoff = maxBackoff
+        self.nextRun = 0
+        self.failures = 0
+        self.lastAttempt = None
+        self.lastSuccess = None
+        self.lastError = None
+        self.lastDuration = None
+
+    def delay(self):
+        if self.failures:
+            base = min(self.interval * (2 ** self.failures), max(self.interval * 2, self.maxBackoff))
+        else:
+            base = self.interval
+        if self.stretch is not None:
+            base = self.stretch(base)
+        return base * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def isHealthy(self):
+        if self.lastSuccess is None:
+            return False
+        return datetime.utcnow() - self.lastSuccess < timedelta(seconds=3 * self.interval)
+
+class FeedPoller(object):
+    """Refresh system-wide feeds on their own schedules."""
+
+    def __init__(self, db, feeds):
+        self.healthCollection = db['pollerHealth']
+        self.feeds = feeds
+
+    def runFeed(self, feed):
+        start = time.time()
+        feed.lastAttempt = datetime.utcnow()
+        try:
+            feed.fetch()
+        except Exception:
+            feed.failures += 1
+            feed.lastError = traceback.format_exc().strip().splitlines()[-1]
+            log.exception("Refreshing %s failed (%d in a row)", feed.name, feed.failures)
+        else:
+            feed.failures = 0
+            feed.lastError = None
+            feed.lastSuccess = datetime.utcnow()
+        feed.lastDuration = time.time() - start
+        feed.nextRun = time.time() + feed.delay()
+        try:
+            self._recordHealth(feed)
+        except Exception:
+            log.exception("Recording health of %s failed", feed.name)
+
+    def _recordHealth(self, feed):
+        self.healthCollection.update({'_id': feed.name},
+                                     {'_id': feed.name,
+                                      'interval': feed.interval,
+                                      'lastAttempt': feed.lastAttempt,
+                                      'lastSuccess': feed.lastSuccess,
+                                      'lastDuration': feed.lastDuration,
+                                      'lastError': feed.lastError,
+                                      'failures': feed.failures,
+                                      'nextRun': datetime.utcfromtimestamp(feed.nextRun),
+                                      'healthy': feed.isHealthy()},
+                                     upsert=True)
+
+    def runOnce(self):
+        for feed in self.feeds:
+            if feed.nextRun <= time.time():
+                self.runFeed(feed)
+
+    def run(self):
+        while True:
+            self.runOnce()
+            nextRun = min(feed.nextRun for feed in self.feeds)
+            time.sleep(max(0, nextRun - time.time()))
+
+def getHealth(db):
+    health = {}
+    for feed in db['pollerHealth'].find():
+        name = feed.pop('_id')
+        if feed['lastSuccess'] is not None:
+            feed['healthy'] = datetime.utcnow() - feed['lastSuccess'] < timedelta(seconds=3 * feed['interval'])
+        for key in ('lastAttempt', 'lastSuccess', 'nextRun'):
+            if feed[key] is not None:
+                feed[key] = feed[key].isoformat() + 'Z'
+        health[name] = feed
+    return health
+
+def wmataFeeds(wmata):
+    return [Feed('wmataRailPredictions', 20, wmata.fetchRailPredictions, stretch=wmata.calls.stretch),
+            Feed('wmataRailIncidents', 120, wmata.fetchRailIncidents, stretch=wmata.calls.stretch),
+            Feed('wmataELESIncidents', 600, wmata.fetchELESIncidents, stretch=wmata.calls.stretch)]
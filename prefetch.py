@@ -0,0 +1,99 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+class HotKeys(object):
+    """Access counts that halve every halfLife seconds."""
+
+    def __init__(self, halfLife=300, maxKeys=5000):
+        self.halfLife = float(halfLife)
+        self.maxKeys = maxKeys
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _score(self, entry, now):
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.halfLife)
+
+    def touch(self, key, value=None):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            score = self._score(entry, now) if entry is not None else 0.0
+            self.entries[key] = (score + 1, now, value)
+            if len(self.entries) > self.maxKeys:
+                keep = heapq.nlargest(self.maxKeys * 3 // 4, self.entries.items(),
+                                      key=lambda item: self._score(item[1], now))
+                self.entries = dict(keep)
+
+    def top(self, count):
+        """The count hottest keys as [(key, score, value)], hottest first."""
+        now = time.time()
+        with self.lock:
+            scored = [(self._score(entry, now), key, entry[2]) for (key, entry) in self.entries.items()]
+        return [(key, score, value) for (score, key, value) in heapq.nlargest(count, scored)]
+
+    def __len__(self):
+        return len(self.entries)
+
+class Prefetcher(object):
+    """Refreshes the hottest keys of one client just before they expire, within its quota."""
+
+    def __init__(self, refresher, calls, topK=50, lead=5, interval=2, minScore=2, quotaShare=0.25,
+                 halfLife=300, maxKeys=5000):
+        self.refresher = refresher
+        self.calls = calls
+        self.topK = topK
+        self.lead = lead
+        self.interval = interval
+        self.minScore = minScore
+        self.quotaShare = quotaShare
+        self.hotKeys = HotKeys(halfLife, maxKeys)
+        self.thread = None
+        self.threadLock = threading.Lock()
+        refresher.prefetcher = self
+
+    def touch(self, key, isFresh, fetch):
+        self.hotKeys.touch(key, (isFresh, fetch))
+        if self.thread is None or not self.thread.is_alive():
+            with self.threadLock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self._run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def budget(self):
+        """Prefetches allowed so far today, or None without a quota."""
+        if not self.calls.dailyQuota:
+            return None
+        now = datetime.now()
+        elapsed = (now - datetime.combine(now.date(), datetime.min.time())).total_seconds()
+        return int(self.quotaShare * self.calls.dailyQuota * min(1.0, (elapsed + 3600) / 86400))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.prefetch()
+            except Exception:
+                log.exception("Prefetching hot keys failed")
+
+    def prefetch(self):
+        """One pass over the hot keys. Returns how many were refreshed."""
+        if self.calls.stretchFactor() > 1:
+            return 0
+        refreshed = 0
+        budget = self.budget()
+        for (key, score, (isFresh, fetch)) in self.hotKeys.top(self.topK):
+            if score < self.minScore:
+                break
+            if isFresh(self.lead):
+                continue
+            if not self.calls.claim('prefetches', budget):
+                break
+            if self.refresher.prefetch(key, lambda: isFresh(self.lead), fetch):
+                refreshed += 1
+        return refreshed
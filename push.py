@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class PredictionChannel(object):
+    """Prediction rows per key, watched once per process for waiting clients."""
+
+    def __init__(self, versions, rows, interval=1.0, idleSeconds=120, maxKeys=1000):
+        self.versions = versions
+        self.rows = rows
+        self.interval = interval
+        self.idleSeconds = idleSeconds
+        self.maxKeys = maxKeys
+        self.keys = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def _start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._watch)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            with self.condition:
+                now = time.time()
+                for key in [key for key, state in self.keys.items() if now - state['requested'] > self.idleSeconds]:
+                    del self.keys[key]
+                keys = self.keys.keys()
+            if keys:
+                try:
+                    self.check(keys)
+                except Exception:
+                    log.exception("Checking %d prediction keys failed", len(keys))
+
+    def check(self, keys):
+        """Reload the rows of keys whose version changed and wake their waiters."""
+        for (key, version) in self.versions(keys).items():
+            with self.condition:
+                state = self.keys.get(key)
+                if state is None or state['version'] == version:
+                    continue
+            rows = self.rows(key)
+            with self.condition:
+                if key in self.keys:
+                    self.keys[key] = self._update(self.keys[key], version, rows)
+                    self.condition.notify_all()
+
+    @staticmethod
+    def _update(state, version, rows):
+        previous = dict((row['id'], row) for row in state['rows'])
+        current = set(row['id'] for row in rows)
+        return {'requested': state['requested'],
+                'version': version,
+                'rows': rows,
+                'previousVersion': state['version'],
+                'diff': {'changed': [row for row in rows if previous.get(row['id']) != row],
+                         'removed': [rowID for rowID in previous if rowID not in current],
+                         'order': [row['id'] for row in rows]}}
+
+    def _track(self, key, version, rows):
+        """Start tracking key, or mark it as just requested."""
+        state = self.keys.pop(key, None)
+        if state is None:
+            state = {'version': version, 'rows': rows, 'previousVersion': None, 'diff': None}
+            while len(self.keys) >= self.maxKeys:
+                self.keys.popitem(last=False)
+        state['requested'] = time.time()
+        self.keys[key] = state
+        return state
+
+    def current(self, key):
+        """(version, rows) for key."""
+        with self.condition:
+            state = self.keys.get(key)
+        if state is None:
+            version = self.versions([key]).get(key)
+            rows = self.rows(key)
+            with self.condition:
+                state = self.keys.get(key) or self._track(key, version, rows)
+        self._start()
+        return (state['version'], state['rows'])
+
+    def wait(self, key, since, timeout):
+        """Wait for key to move past since; returns a diff, all rows, or an empty diff."""
+        deadline = time.time() + timeout
+        (version, rows) = self.current(key)
+        with self.condition:
+            state = self._track(key, version, rows)
+            while state['version'] == since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return {'version': since, 'full': False, 'changed': [], 'removed': [], 'order': None}
+                self.condition.wait(remaining)
+                state = self.keys.get(key, state)
+
+        if state['previousVersion'] == since and state['diff'] is not None:
+            return dict(state['diff'], version=state['version'], full=False)
+        return {'version': state['version'], 'full': True, 'rows': state['rows']}
@@ -0,0 +1,111 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+class CallCounter(object):
+    """Counts upstream calls per day, flushed to Mongo from a background thread."""
+
+    def __init__(self, collection, dailyQuota=None, flushEvery=50, flushInterval=30, maxStretch=10):
+        self.collection = collection
+        self.dailyQuota = dailyQuota
+        self.flushEvery = flushEvery
+        self.flushInterval = flushInterval
+        self.maxStretch = maxStretch
+        self.day = str(date.today())
+        self.pending = 0
+        self.persisted = 0
+        self.lock = threading.Lock()
+        self.due = threading.Event()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def record(self, *args):
+        with self.lock:
+            self._rollover()
+            self.pending += 1
+            if self.pending >= self.flushEvery:
+                self.due.set()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self.due.wait(self.flushInterval)
+            self.due.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Flushing call counts failed")
+
+    def _rollover(self):
+        today = str(date.today())
+        if today != self.day:
+            if self.pending:
+                self.collection.update({'date': self.day}, {'$inc': {'calls': self.pending}}, upsert=True)
+            self.day = today
+            self.pending = 0
+            self.persisted = 0
+
+    def flush(self):
+        with self.lock:
+            self._rollover()
+            (pending, self.pending) = (self.pending, 0)
+            day = self.day
+        try:
+            counts = self.collection.find_and_modify({'date': day}, {'$inc': {'calls': pending}},
+                                                     upsert=True, new=True)
+        except Exception:
+            with self.lock:
+                if day == self.day:
+                    self.pending += pending
+            raise
+        with self.lock:
+            if day == self.day and counts is not None:
+                self.persisted = counts['calls']
+
+    def usedToday(self):
+        with self.lock:
+            self._rollover()
+            return self.persisted + self.pending
+
+    def stretchFactor(self):
+        if not self.dailyQuota:
+            return 1.0
+        used = self.usedToday()
+        remaining = self.dailyQuota - used
+        if remaining <= 0:
+            return float(self.maxStretch)
+
+        now = datetime.now()
+        elapsed = (now - datetime.combine(now.date(), datetime.min.time())).total_seconds()
+        left = 86400 - elapsed
+        projected = used / max(elapsed, 60.0) * left
+        if projected <= remaining:
+            return 1.0
+        return min(float(self.maxStretch), projected / remaining)
+
+    def stretch(self, interval):
+        factor = self.stretchFactor()
+        if isinstance(interval, timedelta):
+            return timedelta(seconds=interval.total_seconds() * factor)
+        return interval * factor
+
+    def claim(self, field, limit):
+        """Increment field of today's document if it is still below limit."""
+        if limit is None:
+            return True
+        claimed = self.collection.find_and_modify({'date': str(date.today()),
+                                                   '$or': [{field: {'$lt': limit}},
+                                                           {field: {'$exists': False}}]},
+                                                  {'$inc': {field: 1}})
+        return claimed is not None
+
+    def getStats(self):
+        return {'date': self.day, 'calls': self.usedToday(), 'dailyQuota': self.dailyQuota,
+                'stretch': self.stretchFactor()}
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from pymongo import Connection
+
+import metrics
+
+from wmata import WMATA
+from nextbus import NextBus
+from connexionz import Connexionz
+from prefetch import Prefetcher
+from spatial import NearbyIndex
+from staticdata import StaticSnapshot
+
+class PerProcess(object):
+    """A value built once per process, and again after a fork."""
+
+    def __init__(self, build):
+        self.build = build
+        self.pid = None
+        self.value = None
+        self.seconds = None
+        self.lock = threading.Lock()
+        self.lockPid = os.getpid()
+
+    def get(self):
+        pid = os.getpid()
+        if self.pid != pid:
+            if self.lockPid != pid:
+                self.lock = threading.Lock()
+                self.lockPid = pid
+            with self.lock:
+                if self.pid != pid:
+                    start = time.time()
+                    self.value = self.build()
+                    self.seconds = time.time() - start
+                    self.pid = pid
+        return self.value
+
+class Services(object):
+    """The Mongo connection and agency clients of one process."""
+
+    def __init__(self, config):
+        self.connection = Connection()
+        self.db = self.connection[config['DB_NAME']]
+
+        httpOptions = config.get('UPSTREAM_HTTP', {})
+        self.wmata = WMATA(config['WMATA_KEY'], self.db, lazyRefresh=not config.get('FEED_POLLER', False),
+                           dailyQuota=config.get('WMATA_DAILY_QUOTA', 50000), httpOptions=httpOptions,
+                           baseURL=config.get('WMATA_BASE_URL'))
+        self.circulator = NextBus("dc-circulator", self.db, 'nextbus', dailyQuota=config.get('NEXTBUS_DAILY_QUOTA'),
+                                  httpOptions=httpOptions, baseURL=config.get('NEXTBUS_BASE_URL'))
+        self.art = Connexionz(config.get('ART_BASE_URL', "http://realtime.commuterpage.com"), "ART", self.db,
+                              'art', dailyQuota=config.get('ART_DAILY_QUOTA'), httpOptions=httpOptions)
+        self.clients = [('wmata', self.wmata), ('circulator', self.circulator), ('art', self.art)]
+        for (upstream, client) in self.clients:
+            metrics.instrumentClient(client, upstream)
+
+        self.static = None
+        if config.get('STATIC_SNAPSHOT'):
+            self.static = StaticSnapshot(config['STATIC_SNAPSHOT'])
+            for (upstream, client) in self.clients:
+                client.static = self.static
+
+        self.nearbyIndex = NearbyIndex([('wmataStation', self.wmata.getStations, [self.wmata.stationsGeneration]),
+                                        ('wmataStop', self.wmata.getAllStops, [self.wmata.stopsGeneration]),
+                                        ('circulatorStop', self.circulator.getAllStops,
+                                         [self.circulator.stopsGeneration]),
+                                        ('artStop', self.art.getAllStops, [self.art.stopsGeneration])],
+                                       maxRadiusMiles=config.get('NEARBY_MAX_RADIUS', 3.0))
+
+        self.prefetchers = {}
+        if config.get('PREFETCH_TOP_K', 50):
+            for (upstream, client) in self.clients:
+                if not client.calls.dailyQuota:
+                    continue
+                self.prefetchers[upstream] = Prefetcher(client.refresher, client.calls,
+                                                        topK=config.get('PREFETCH_TOP_K', 50),
+                                                        lead=config.get('PREFETCH_LEAD_SECONDS', 5),
+                                                        quotaShare=config.get('PREFETCH_QUOTA_SHARE', 0.25))
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+class SnapshotStore(object):
+    """A feed stored as whole generations behind a pointer document."""
+
+    def __init__(self, db, collection):
+        self.pointersCollection = db['snapshotPointers']
+        self.collection = collection
+        self.name = collection.name
+
+    def current(self):
+        return self.pointersCollection.find_one({'_id': self.name})
+
+    def isFresh(self):
+        pointer = self.current()
+        return pointer is not None and pointer['expiration'] >= datetime.utcnow()
+
+    def publish(self, documents, expiration):
+        generation = ObjectId()
+        for document in documents:
+            document['generation'] = generation
+        if len(documents) > 0:
+            self.collection.insert(documents)
+
+        previous = self.current()
+        self.pointersCollection.update({'_id': self.name},
+                                       {'_id': self.name,
+                                        'generation': generation,
+                                        'expiration': expiration,
+                                        'published': datetime.utcnow(),
+                                        'count': len(documents)},
+                                       upsert=True)
+        if previous is not None:
+            # ObjectIds are time-ordered; newer ones may belong to a concurrent publish.
+            self.collection.remove({'generation': {'$lt': previous['generation']}})
+        return generation
+
+    def find(self, pointer, query=None, **kwargs):
+        query = dict(query or {})
+        if pointer is None:
+            query['generation'] = {'$in': []}
+        else:
+            query['generation'] = pointer['generation']
+        return self.collection.find(query, **kwargs)
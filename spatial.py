@@ -0,0 +1,90 @@
+import math
+import threading
+from collections import defaultdict
+
+EARTH_RADIUS_MILES = 3959.0
+MILES_PER_DEGREE = EARTH_RADIUS_MILES * math.pi / 180
+
+def distanceMiles(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+def isFinite(value):
+    return not (math.isinf(value) or math.isnan(value))
+
+class GridIndex(object):
+    """Points bucketed into a fixed lon/lat grid."""
+
+    def __init__(self, points, cellDegrees=0.005):
+        self.cellDegrees = cellDegrees
+        self.cells = defaultdict(list)
+        self.size = 0
+        for (longitude, latitude, item) in points:
+            self.cells[self._cell(longitude, latitude)].append((longitude, latitude, item))
+            self.size += 1
+
+    def _cell(self, longitude, latitude):
+        return (int(math.floor(longitude / self.cellDegrees)),
+                int(math.floor(latitude / self.cellDegrees)))
+
+    def near(self, longitude, latitude, radiusMiles):
+        latSpan = radiusMiles / MILES_PER_DEGREE
+        lonSpan = latSpan / max(math.cos(math.radians(latitude)), 0.01)
+        (minX, minY) = self._cell(longitude - lonSpan, latitude - latSpan)
+        (maxX, maxY) = self._cell(longitude + lonSpan, latitude + latSpan)
+
+        results = []
+        for x in range(minX, maxX + 1):
+            for y in range(minY, maxY + 1):
+                for (pointLon, pointLat, item) in self.cells.get((x, y), ()):
+                    distance = distanceMiles(longitude, latitude, pointLon, pointLat)
+                    if distance <= radiusMiles:
+                        results.append((distance, item))
+        results.sort(key=lambda x: x[0])
+        return results
+
+class NearbyIndex(object):
+    """Spatial index over every agency's stops, rebuilt when their data changes."""
+
+    def __init__(self, sources, cellDegrees=0.005, maxRadiusMiles=3.0):
+        self.sources = sources
+        self.cellDegrees = cellDegrees
+        self.maxRadiusMiles = maxRadiusMiles
+        self.generation = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def _currentGeneration(self):
+        return tuple(tuple(marker.current() for marker in generations)
+                     for (kind, loadDocuments, generations) in self.sources)
+
+    def _build(self):
+        points = []
+        for (kind, loadDocuments, generations) in self.sources:
+            for document in loadDocuments():
+                document.pop('_id', None)
+                (longitude, latitude) = document['location']
+                points.append((longitude, latitude, (kind, document)))
+        return GridIndex(points, self.cellDegrees)
+
+    def getIndex(self):
+        generation = self._currentGeneration()
+        if generation != self.generation:
+            with self.lock:
+                if generation != self.generation:
+                    self.index = self._build()
+                    self.generation = generation
+        return self.index
+
+    def near(self, longitude, latitude, radiusMiles=0.25, kinds=None, limit=None):
+        if not all(isFinite(value) for value in (longitude, latitude, radiusMiles)):
+            raise ValueError("Coordinates and radius must be finite")
+        radiusMiles = min(radiusMiles, self.maxRadiusMiles)
+        results = [{'distance': distance, 'kind': kind, 'stop': document}
+                   for (distance, (kind, document)) in self.getIndex().near(longitude, latitude, radiusMiles)
+                   if kinds is None or kind in kinds]
+        if limit is not None:
+            results = results[:limit]
+        return results
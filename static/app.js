@@ -40,4 +40,105 @@ $(document).delegate("#geo", "pageinit", function() {
                        
   var destination = $(this).data('destination');
   get_location();
-});
\ No newline at end of file
+});
+
+var predictionRows = {
+  rail: function(row) {
+    if (row.divider) {
+      return $('<li data-role="list-divider"></li>').text(row.divider);
+    }
+    var li = $('<li><div class="circle"></div>&nbsp;<small></small><p class="ui-li-aside"></p><span class="ui-li-count"></span></li>');
+    li.find('.circle').addClass(row.line);
+    li.find('small').text(row.dest);
+    li.find('.ui-li-aside').text(row.car + ' cars');
+    li.find('.ui-li-count').text(row.min);
+    return li;
+  },
+  bus: function(row) {
+    var li = $('<li>&nbsp;<small></small><span class="ui-li-count"></span></li>');
+    li.prepend(document.createTextNode(row.route));
+    li.find('small').text(row.direction);
+    li.find('.ui-li-count').text(row.minutes);
+    return li;
+  }
+};
+
+$(document).delegate("div[data-updates]", "pageshow", function() {
+  var page = $(this);
+  var list = page.find('ul[data-role="listview"]');
+  var render = predictionRows[page.data('rows')];
+  var url = page.data('updates');
+  var version = page.attr('data-version');
+  var interval = Math.max(1, page.data('pollInterval') || 15) * 1000;
+  var token = (page.data('pollToken') || 0) + 1;
+  page.data('pollToken', token);
+
+  function rowElement(row) {
+    return render(row).attr('data-row-id', row.id);
+  }
+
+  function place(li) {
+    var empty = list.children('.empty');
+    if (empty.length) {
+      empty.before(li);
+    } else {
+      list.append(li);
+    }
+  }
+
+  function patch(update) {
+    if (update.full) {
+      list.children('[data-row-id]').remove();
+      $.each(update.rows, function(i, row) {
+        place(rowElement(row));
+      });
+    } else {
+      var existing = {};
+      list.children('[data-row-id]').each(function() {
+        existing[$(this).attr('data-row-id')] = $(this);
+      });
+      $.each(update.removed, function(i, rowID) {
+        if (existing[rowID]) {
+          existing[rowID].remove();
+        }
+      });
+      $.each(update.changed, function(i, row) {
+        var li = rowElement(row);
+        if (existing[row.id]) {
+          existing[row.id].replaceWith(li);
+        }
+        existing[row.id] = li;
+      });
+      $.each(update.order, function(i, rowID) {
+        place(existing[rowID]);
+      });
+    }
+
+    page.find('.stale').remove();
+    list.children('.empty').toggle(list.children('[data-row-id]').length == 0);
+    list.listview('refresh');
+  }
+
+  function poll() {
+    if (page.data('pollToken') != token) {
+      return;
+    }
+    $.ajax({url: url, data: {since: version}, dataType: 'json', cache: false, timeout: 60000,
+            success: function(update) {
+              if (update.version != version && (update.full || update.order)) {
+                patch(update);
+                version = update.version;
+              }
+              setTimeout(poll, interval);
+            },
+            error: function() {
+              setTimeout(poll, Math.max(interval, 5000));
+            }});
+  }
+
+  setTimeout(poll, interval);
+});
+
+$(document).delegate("div[data-updates]", "pagehide", function() {
+  $(this).data('pollToken', ($(this).data('pollToken') || 0) + 1);
+});
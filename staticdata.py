@@ -0,0 +1,207 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'CTISTAT2'
+PREFIX = struct.Struct('<8sI')
+
+def indexKey(value):
+    """value as an index key, tagged with its type."""
+    if isinstance(value, (list, tuple)):
+        return '\x00'.join(indexKey(item) for item in value)
+    if isinstance(value, bool):
+        return 'b%d' % value
+    if isinstance(value, (int, long)) or (isinstance(value, float) and value.is_integer()):
+        return 'n%d' % value
+    if isinstance(value, float):
+        return 'n%r' % value
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if isinstance(value, unicode):
+        return 's' + value.encode('utf-8')
+    return 'j' + json.dumps(value, sort_keys=True)
+
+def _fieldsKey(fields):
+    return fields if isinstance(fields, basestring) else '+'.join(fields)
+
+def _documentKey(document, fields):
+    """document's key for fields, or None if it lacks one of them."""
+    if isinstance(fields, basestring):
+        value = document.get(fields)
+        return indexKey(value) if value is not None else None
+    values = [document.get(field) for field in fields]
+    return indexKey(values) if None not in values else None
+
+def _uint32s(values):
+    return struct.pack('<%dI' % len(values), *values)
+
+def writeStaticSnapshot(path, tables):
+    """Write tables [(name, generation, documents, keys)] to path atomically."""
+    sections = []
+    position = [0]
+
+    def section(data):
+        sections.append(data)
+        offset = position[0]
+        position[0] += len(data)
+        return offset
+
+    header = {'created': datetime.utcnow().isoformat() + 'Z', 'tables': {}}
+    for (name, generation, documents, keys) in tables:
+        records = []
+        recordOffsets = [0]
+        documents = list(documents)
+        for document in documents:
+            record = json.dumps(dict((key, value) for (key, value) in document.items()
+                                     if key not in ('_id', 'contentHash')),
+                                separators=(',', ':'), sort_keys=True)
+            records.append(record)
+            recordOffsets.append(recordOffsets[-1] + len(record))
+        table = {'generation': generation, 'count': len(records),
+                 'offsets': section(_uint32s(recordOffsets)), 'records': section(''.join(records)),
+                 'indexes': {}}
+
+        for fields in keys:
+            entries = sorted((key, number) for (key, number) in
+                             ((_documentKey(document, fields), number) for (number, document) in enumerate(documents))
+                             if key is not None)
+            stringOffsets = [0]
+            for (key, number) in entries:
+                stringOffsets.append(stringOffsets[-1] + len(key))
+            table['indexes'][_fieldsKey(fields)] = {
+                'strings': section(''.join(key for (key, number) in entries)),
+                'offsets': section(_uint32s(stringOffsets)),
+                'numbers': section(_uint32s([number for (key, number) in entries])),
+                'count': len(entries)}
+        header['tables'][name] = table
+
+    headerData = json.dumps(header, separators=(',', ':'))
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'wb') as output:
+        output.write(PREFIX.pack(MAGIC, len(headerData)))
+        output.write(headerData)
+        for data in sections:
+            output.write(data)
+    os.rename(temporary, path)
+    header['bytes'] = PREFIX.size + len(headerData) + position[0]
+    return header
+
+class SnapshotTable(object):
+    """One table of a mapped snapshot."""
+
+    def __init__(self, data, base, table):
+        self.data = data
+        self.base = base
+        self.table = table
+        self.count = table['count']
+
+    def _uint32(self, section, index):
+        return struct.unpack_from('<I', self.data, self.base + section + 4 * index)[0]
+
+    def record(self, number):
+        start = self._uint32(self.table['offsets'], number)
+        end = self._uint32(self.table['offsets'], number + 1)
+        records = self.base + self.table['records']
+        return json.loads(self.data[records + start:records + end])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for number in xrange(self.count):
+            yield self.record(number)
+
+    def find(self, fields, value):
+        """The first record whose fields equal value, or None."""
+        index = self.table['indexes'][_fieldsKey(fields)]
+        if value is None or (isinstance(value, (list, tuple)) and None in value):
+            return None
+        wanted = indexKey(value)
+        strings = self.base + index['strings']
+        count = index['count']
+        (low, high) = (0, count)
+        while low < high:
+            middle = (low + high) // 2
+            start = self._uint32(index['offsets'], middle)
+            end = self._uint32(index['offsets'], middle + 1)
+            if self.data[strings + start:strings + end] < wanted:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count:
+            start = self._uint32(index['offsets'], low)
+            end = self._uint32(index['offsets'], low + 1)
+            if self.data[strings + start:strings + end] == wanted:
+                return self.record(self._uint32(index['numbers'], low))
+        return None
+
+class StaticSnapshot(object):
+    """A mapped snapshot file, remapped when replaced; outdated tables are not served."""
+
+    def __init__(self, path, checkInterval=5):
+        self.path = path
+        self.checkInterval = checkInterval
+        self.identity = None
+        self.mapped = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def _map(self):
+        with open(self.path, 'rb') as snapshotFile:
+            data = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, headerLength) = PREFIX.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a static snapshot" % self.path)
+        header = json.loads(data[PREFIX.size:PREFIX.size + headerLength])
+        return (data, PREFIX.size + headerLength, header)
+
+    def current(self):
+        """(data, base, header) of the mapped file, or None without one."""
+        if time.time() - self.checked > self.checkInterval:
+            with self.lock:
+                if time.time() - self.checked > self.checkInterval:
+                    try:
+                        status = os.stat(self.path)
+                        identity = (status.st_ino, status.st_mtime, status.st_size)
+                    except OSError:
+                        identity = None
+                    if identity != self.identity:
+                        self.mapped = None
+                        if identity is not None:
+                            try:
+                                self.mapped = self._map()
+                            except (EnvironmentError, ValueError, struct.error):
+                                log.exception("Mapping static snapshot %s failed", self.path)
+                        self.identity = identity
+                    self.checked = time.time()
+        return self.mapped
+
+    def table(self, name, generation):
+        mapped = self.current()
+        if mapped is None:
+            return None
+        (data, base, header) = mapped
+        table = header['tables'].get(name)
+        if table is None or table['generation'] != generation.current():
+            return None
+        return SnapshotTable(data, base, table)
+
+    def getStats(self):
+        mapped = self.current()
+        if mapped is None:
+            return {'mapped': False}
+        return {'mapped': True, 'bytes': len(mapped[0]), 'tables': len(mapped[2]['tables']),
+                'created': mapped[2]['created']}
+
+def staticTable(static, name, generation):
+    """static.table(name, generation), or None when there is no snapshot."""
+    if static is None:
+        return None
+    return static.table(name, generation)
@@ -0,0 +1,66 @@
+import requests
+
+def upstreamSession(callHook=None, poolSize=10, timeout=10, retries=2):
+    """A keep-alive, compressed requests session for one agency's API."""
+    hooks = {}
+    if callHook is not None:
+        hooks['args'] = callHook
+    return requests.session(hooks=hooks,
+                            headers={'Accept-Encoding': 'gzip, deflate'},
+                            timeout=timeout,
+                            config={'keep_alive': True,
+                                    'pool_connections': poolSize,
+                                    'pool_maxsize': poolSize,
+                                    'max_retries': retries})
+
+def connectionStats(session):
+    """Requests made and connections opened per upstream host so far."""
+    stats = {}
+    pools = session.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+        stats[host] = {'requests': pool.num_requests,
+                       'connections': pool.num_connections,
+                       'reused': max(0, pool.num_requests - pool.num_connections)}
+    return stats
+
+class ConditionalGet(object):
+    """ETag/Last-Modified validators for static upstream files."""
+
+    def __init__(self, db):
+        self.db = db
+        self.validatorsCollection = db['upstreamValidators']
+
+    def get(self, session, url, name, **kwargs):
+        """GET url, or None if it is unchanged and collection name is not empty."""
+        headers = dict(kwargs.pop('headers', {}))
+        if self.db[name].find_one(fields={'_id': 1}) is None:
+            self.forget(name)
+            validators = None
+        else:
+            validators = self.validatorsCollection.find_one({'_id': name})
+        if validators is not None:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('lastModified'):
+                headers['If-Modified-Since'] = validators['lastModified']
+
+        r = session.get(url, headers=headers, **kwargs)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        return r
+
+    def save(self, name, response):
+        """Remember response's validators once its content is loaded."""
+        self.validatorsCollection.update({'_id': name},
+                                         {'_id': name,
+                                          'etag': response.headers.get('etag'),
+                                          'lastModified': response.headers.get('last-modified')},
+                                         upsert=True)
+
+    def forget(self, name):
+        self.validatorsCollection.remove({'_id': name})
@@ -1,51 +1,132 @@
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta
 import json
+import threading
 from collections import defaultdict
 
-import requests
-
-from pymongo import Connection, GEO2D, ASCENDING
+from pymongo import Connection, ASCENDING
+
+from cache import DataGeneration, LRUCache
+from coalesce import SingleFlight, freshnessCheck
+from loader import BulkLoader, LoadSummary
+from quota import CallCounter
+from snapshot import SnapshotStore
+from staticdata import staticTable
+from upstream import ConditionalGet, upstreamSession
+
+TRACK_TITLES = {'A1': 'To Glenmont via Downtown',
+                'A2': 'To Shady Grove',
+                'B1': 'To Glenmont',
+                'B2': 'To Shady Grove via Downtown',
+                'C1': 'To Maryland via Downtown',
+                'C2': 'To Virginia',
+                'D1': 'To Maryland',
+                'D2': 'To Virginia via Downtown',
+                'E1': 'To Greenbelt',
+                'E2': 'To Maryland and Virginia via Downtown',
+                'F1': 'To Greenbelt via Downtown',
+                'F2': 'To Maryland and Virginia',
+                'G1': 'To Largo',
+                'G2': 'To Virginia via Downtown',
+                'J1': 'To Maryland via Downtown',
+                'J2': 'To Franconia-Springfield',
+                'K1': 'To Maryland via Downtown',
+                'K2': 'To Vienna',
+                }
+
+def getTrack(rtu, track):
+    return rtu[0] + str(track)
+
+def getTitle(track):
+    return TRACK_TITLES.get(track, 'Track ' + track[1:])
+
+class RailBoard(object):
+    def __init__(self, generation, expiration, predictions):
+        self.generation = generation
+        self.expiration = expiration
+        trains = defaultdict(list)
+        for prediction in predictions:
+            trains[(prediction['locationCode'], prediction['track'])].append(
+                dict((key, value) for (key, value) in prediction.items() if key not in ('_id', 'generation')))
+
+        self.groups = defaultdict(list)
+        for ((locationCode, track), groupTrains) in trains.items():
+            groupTrains.sort(key=lambda train: train['minSort'])
+            trackKey = getTrack(locationCode, track)
+            self.groups[locationCode].append((trackKey, {'locationCode': locationCode,
+                                                         'track': track,
+                                                         'title': getTitle(trackKey),
+                                                         'trains': groupTrains}))
+        for groups in self.groups.values():
+            groups.sort(key=lambda group: group[0])
+        self.groups = dict(self.groups)
+
+    def station(self, rtus):
+        groups = []
+        for rtu in rtus:
+            groups.extend(self.groups.get(rtu, ()))
+        return [group for (trackKey, group) in sorted(groups, key=lambda group: group[0])]
 
 class WMATA(object):
-    def __init__(self, apiKey, db):
-        self.rs = requests.session(hooks=dict(args=lambda x: self.logCall(x)))
+    def __init__(self, apiKey, db, lazyRefresh=True, dailyQuota=None, httpOptions=None, baseURL=None):
+        self.baseURL = baseURL or "http://api.wmata.com"
+        self.lazyRefresh = lazyRefresh
+        self.calls = CallCounter(db['wmataRateLimit'], dailyQuota)
+        self.rs = upstreamSession(self.calls.record, **(httpOptions or {}))
+        self.conditional = ConditionalGet(db)
         self.apiKey = apiKey
         self.stopsCollection = db['wmataStops']
-        self.stopsCollection.create_index([("location", GEO2D)])
         self.routesCollection = db['wmataRoutes']
         self.stationsCollection = db['wmataStations']
-        self.stationsCollection.create_index([("location", GEO2D)])
         self.busPredictionsCollection = db['wmataBusPredictions']
         self.railPredictionsCollection = db['wmataRailPredictions']
         self.railIncidentsCollection = db['wmataRailIncidents']
         self.elesIncidentsCollection = db['wmataELESIncidents']
-        self.apiRateLimitCollection = db['wmataRateLimit']
-
-    def logCall(self, args):
-        today = str(date.today())
-        self.apiRateLimitCollection.update({'date': today}, {'$inc': {'calls': 1}}, upsert=True)        
-
-    def fetchStops(self):
-        r = self.rs.get("http://api.wmata.com/Bus.svc/json/JStops?api_key=" + self.apiKey)
-        r.raise_for_status()
+        self.railPredictionsSnapshot = SnapshotStore(db, self.railPredictionsCollection)
+        self.railIncidentsSnapshot = SnapshotStore(db, self.railIncidentsCollection)
+        self.elesIncidentsSnapshot = SnapshotStore(db, self.elesIncidentsCollection)
+        self.refresher = SingleFlight(db)
+        self.railBoard = None
+        self.railBoardLock = threading.Lock()
+        self.stopsGeneration = DataGeneration(db, 'wmataStops')
+        self.stationsGeneration = DataGeneration(db, 'wmataStations')
+        self.stopCache = LRUCache(maxSize=10000, generations=[self.stopsGeneration])
+        self.static = None
+        self.elesSummary = (None, [])
+
+    def fetchStops(self, batchSize=500, force=False):
+        r = self.conditional.get(self.rs, self.baseURL + "/Bus.svc/json/JStops?api_key=" + self.apiKey,
+                                 self.stopsCollection.name)
+        if r is None:
+            summary = LoadSummary(self.stopsCollection.name)
+            summary.notModified = True
+            return summary
 
         stops = json.loads(r.text)
+        stopsOut = []
 
         for stop in stops['Stops']:
             try:
-                stopData = {'name': stop['Name'] or 'Stop ' + stop['stopID'],
+                stopData = {'name': stop['Name'] or 'Stop ' + stop['StopID'],
                             'id': stop['StopID'],
                             'location': [float(stop['Lon']),
                                          float(stop['Lat'])]}
-                self.stopsCollection.update({'id': stopData['id']},
-                                            stopData,
-                                            upsert=True)
+                stopsOut.append(stopData)
             except Exception:
                 print stop
 
-    def fetchStations(self):
-        r = self.rs.get("http://api.wmata.com/Rail.svc/json/JStations?api_key=" + self.apiKey)
-        r.raise_for_status()
+        summary = BulkLoader(self.stopsCollection, ['id'], batchSize=batchSize, allowEmpty=force).load(stopsOut)
+        if summary.changed():
+            self.stopsGeneration.bump()
+        self.conditional.save(self.stopsCollection.name, r)
+        return summary
+
+    def fetchStations(self, batchSize=500, force=False):
+        r = self.conditional.get(self.rs, self.baseURL + "/Rail.svc/json/JStations?api_key=" + self.apiKey,
+                                 self.stationsCollection.name)
+        if r is None:
+            summary = LoadSummary(self.stationsCollection.name)
+            summary.notModified = True
+            return summary
 
         stations = json.loads(r.text)
 
@@ -70,11 +151,15 @@ class WMATA(object):
                 stationData['lines'] |= lines
 
         for station in stationsOut.values():
-            station['rtus'] = list(station['rtus'])
+            station['rtus'] = sorted(list(station['rtus']))
             station['lines'] = sorted(list(station['lines']))
-            self.stationsCollection.update({'name': station['name']},
-                                           station,
-                                           upsert=True)
+
+        summary = BulkLoader(self.stationsCollection, ['name'],
+                             batchSize=batchSize, allowEmpty=force).load(stationsOut.values())
+        if summary.changed():
+            self.stationsGeneration.bump()
+        self.conditional.save(self.stationsCollection.name, r)
+        return summary
 
     @staticmethod
     def minutesForSort(minutes):
@@ -86,12 +171,12 @@ class WMATA(object):
             return int(minutes)
 
     def fetchRailPredictions(self):
-        r = self.rs.get("http://api.wmata.com/StationPrediction.svc/json/GetPrediction/All?api_key=" + \
+        r = self.rs.get(self.baseURL + "/StationPrediction.svc/json/GetPrediction/All?api_key=" + \
                          self.apiKey)
         r.raise_for_status()
 
         predictions = json.loads(r.text)
-        expirationTime = datetime.utcnow() + timedelta(seconds=20)
+        expirationTime = datetime.utcnow() + self.calls.stretch(timedelta(seconds=20))
         predictionsOut = []
         
         for train in predictions['Trains']:
@@ -109,17 +194,18 @@ class WMATA(object):
                               'expiration': expirationTime}
             predictionsOut.append(predictionData)
             
-        self.railPredictionsCollection.remove()
-        if len(predictionsOut) > 0:
-            self.railPredictionsCollection.insert(predictionsOut)
+        board = RailBoard(None, expirationTime, predictionsOut)
+        board.generation = self.railPredictionsSnapshot.publish(predictionsOut, expirationTime)
+        with self.railBoardLock:
+            self.railBoard = board
 
     def fetchRailIncidents(self):
-        r = self.rs.get("http://api.wmata.com/Incidents.svc/json/Incidents?api_key=" + self.apiKey)
+        r = self.rs.get(self.baseURL + "/Incidents.svc/json/Incidents?api_key=" + self.apiKey)
         r.raise_for_status()
 
         incidents = json.loads(r.text)
         
-        expirationTime = datetime.utcnow() + timedelta(minutes=2)
+        expirationTime = datetime.utcnow() + self.calls.stretch(timedelta(minutes=2))
         incidentsOut = []
         for incident in incidents['Incidents']:
             incidentData = {'lines': incident['LinesAffected'].rstrip(';').split(';'),
@@ -128,18 +214,16 @@ class WMATA(object):
                             }
             incidentsOut.append(incidentData)
 
-        self.railIncidentsCollection.remove()
-        if len(incidentsOut) > 0:
-            self.railIncidentsCollection.insert(incidentsOut)
+        self.railIncidentsSnapshot.publish(incidentsOut, expirationTime)
         
 
     def fetchELESIncidents(self):
-        r = self.rs.get("http://api.wmata.com/Incidents.svc/json/ElevatorIncidents?api_key=" + self.apiKey)
+        r = self.rs.get(self.baseURL + "/Incidents.svc/json/ElevatorIncidents?api_key=" + self.apiKey)
         r.raise_for_status()
 
         incidents = json.loads(r.text)
         
-        expirationTime = datetime.utcnow() + timedelta(minutes=10)
+        expirationTime = datetime.utcnow() + self.calls.stretch(timedelta(minutes=10))
         incidentsOut = []
         for incident in incidents['ElevatorIncidents']:
             incidentData = {'displayOrder': int(incident['DisplayOrder']),
@@ -153,17 +237,16 @@ class WMATA(object):
                             }
             incidentsOut.append(incidentData)
 
-        self.elesIncidentsCollection.remove()
-        if len(incidentsOut) > 0:
-            self.elesIncidentsCollection.insert(incidentsOut)
+        self.elesIncidentsSnapshot.publish(incidentsOut, expirationTime)
     
     def fetchBusPredictions(self, stopID):
-        r = requests.get("http://api.wmata.com/NextBusService.svc/json/JPredictions?StopID=" + \
+        r = self.rs.get(self.baseURL + "/NextBusService.svc/json/JPredictions?StopID=" + \
                          stopID + "&api_key=" + self.apiKey)
         r.raise_for_status()
 
         predictions = json.loads(r.text)
-        expirationTime = datetime.utcnow() + timedelta(minutes=1)
+        fetched = datetime.utcnow()
+        expirationTime = fetched + self.calls.stretch(timedelta(minutes=1))
         predictionsOut = []
         
         for prediction in predictions['Predictions']:
@@ -171,6 +254,7 @@ class WMATA(object):
                               'route': prediction['RouteID'],
                               'direction': prediction['DirectionText'],
                               'minutes': int(prediction['Minutes']),
+                              'fetched': fetched,
                               'expiration': expirationTime}
             predictionsOut.append(predictionData)
             
@@ -178,7 +262,15 @@ class WMATA(object):
         if len(predictionsOut) > 0:
             self.busPredictionsCollection.insert(predictionsOut)
     
+    def staticTables(self):
+        return [('wmataStops', self.stopsGeneration.current(fresh=True), self.stopsCollection.find(), ['id']),
+                ('wmataStations', self.stationsGeneration.current(fresh=True),
+                 self.stationsCollection.find(sort=[('name', ASCENDING)]), [])]
+
     def getStations(self):
+        table = staticTable(self.static, 'wmataStations', self.stationsGeneration)
+        if table is not None:
+            return iter(table)
         return self.stationsCollection.find(sort=[('name', ASCENDING)])
 
     def getStationsNear(self, longitude, latitude):
@@ -189,78 +281,133 @@ class WMATA(object):
         return self.stopsCollection.find({'location': {'$nearSphere': [longitude, latitude],
                                                        '$maxDistance': 0.25/3959}})
 
+    def getAllStops(self):
+        table = staticTable(self.static, 'wmataStops', self.stopsGeneration)
+        if table is not None:
+            return iter(table)
+        return self.stopsCollection.find(fields={'name': 1, 'id': 1, 'location': 1})
+
     def getStop(self, stopID):
-        return self.stopsCollection.find_one({'id': stopID})
+        table = staticTable(self.static, 'wmataStops', self.stopsGeneration)
+        if table is not None:
+            return table.find('id', stopID)
+        return self.stopCache.get(stopID, lambda: self.stopsCollection.find_one({'id': stopID}))
+
+    def _conditionalUpdateSnapshot(self, key, snapshot, fetch):
+        pointer = snapshot.current()
+        if not self.lazyRefresh:
+            return pointer
+        refreshed = self.refresher.revalidate(key, pointer['expiration'] if pointer is not None else None,
+                                              snapshot.isFresh, fetch, prefetch=False)
+        if refreshed or pointer is None:
+            pointer = snapshot.current()
+        return pointer
+
+    def _conditionalUpdateRailPredictions(self):
+        return self._conditionalUpdateSnapshot('wmataRailPredictions', self.railPredictionsSnapshot,
+                                               self.fetchRailPredictions)
+
+    def getRailBoard(self):
+        board = self.railBoard
+        if board is not None and board.expiration >= datetime.utcnow():
+            self.refresher.hit('wmataRailPredictions')
+            return board
+
+        pointer = self._conditionalUpdateRailPredictions()
+        if pointer is None:
+            return None
+        with self.railBoardLock:
+            if self.railBoard is None or self.railBoard.generation != pointer['generation']:
+                self.railBoard = RailBoard(pointer['generation'], pointer['expiration'],
+                                           self.railPredictionsSnapshot.find(pointer))
+            elif self.railBoard.expiration != pointer['expiration']:
+                self.railBoard.expiration = pointer['expiration']
+            return self.railBoard
 
     def getRailPredictions(self, rtus):
-        expiration = self.railPredictionsCollection.find_one(fields={'expiration': '1'})
-        if expiration is None or expiration['expiration'] < datetime.utcnow():
-            self.fetchRailPredictions()
-
-        predictions = self.railPredictionsCollection.find({'locationCode': {'$in': rtus}})
-
-        predictionsOut = defaultdict(list)
-
-        for prediction in predictions:
-            predictionsOut[(prediction['locationCode'], prediction['track'])].append(prediction)
-
-        for predictionsList in predictionsOut.values():
-            predictionsList.sort(key=lambda x: x['minSort'])
-
-        return predictionsOut
+        board = self.getRailBoard()
+        return board.station(rtus) if board is not None else []
 
     def _conditionalUpdateRailIncidents(self):
-        expiration = self.railIncidentsCollection.find_one(fields={'expiration': '1'})
-        if expiration is None or expiration['expiration'] < datetime.utcnow():
-            self.fetchRailIncidents()
+        return self._conditionalUpdateSnapshot('wmataRailIncidents', self.railIncidentsSnapshot,
+                                               self.fetchRailIncidents)
             
-    def getRailIncidents(self):
-        self._conditionalUpdateRailIncidents()
+    def getRailIncidentsSnapshot(self):
+        return self._conditionalUpdateRailIncidents()
+
+    def getRailIncidents(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self._conditionalUpdateRailIncidents()
 
-        incidents = self.railIncidentsCollection.find({})
+        incidents = self.railIncidentsSnapshot.find(snapshot)
         return incidents
 
     def getRailIncidentCount(self):
-        self._conditionalUpdateRailIncidents()
+        snapshot = self._conditionalUpdateRailIncidents()
 
-        return self.railIncidentsCollection.count()
+        return snapshot['count'] if snapshot is not None else 0
 
     def _conditionalUpdateELESIncidents(self):
-        expiration = self.elesIncidentsCollection.find_one(fields={'expiration': '1'})
-        if expiration is None or expiration['expiration'] < datetime.utcnow():
-            self.fetchELESIncidents()
+        return self._conditionalUpdateSnapshot('wmataELESIncidents', self.elesIncidentsSnapshot,
+                                               self.fetchELESIncidents)
             
+    def getELESIncidentsSnapshot(self):
+        return self._conditionalUpdateELESIncidents()
+
     def getELESIncidentsByStation(self, rtus):
-        self._conditionalUpdateELESIncidents()
+        snapshot = self._conditionalUpdateELESIncidents()
 
-        incidents = self.elesIncidentsCollection.find({'unitStatus': 'O', 'stationCode': {'$in': rtus}},
-                                                      sort=[('displayOrder', ASCENDING)])
+        incidents = self.elesIncidentsSnapshot.find(snapshot, {'unitStatus': 'O', 'stationCode': {'$in': rtus}},
+                                                    sort=[('displayOrder', ASCENDING)])
         return incidents
 
-    def getELESIncidentStations(self):
-        self._conditionalUpdateELESIncidents()
-
-        openIncidents = self.elesIncidentsCollection.find({'unitStatus': 'O'})
-        incidentRTUs = openIncidents.distinct('stationCode')
-
-        stations = self.stationsCollection.find({'rtus': {'$in': incidentRTUs}}, sort=[('name', ASCENDING)])
-        return stations
-
     def getELESIncidentCount(self):
-        self._conditionalUpdateELESIncidents()
-
-        return self.elesIncidentsCollection.find({'unitStatus': 'O'}).count()
-
-    def getELESIncidentCountByStation(self, rtus):
-        self._conditionalUpdateELESIncidents()
-
-        return self.elesIncidentsCollection.find({'unitStatus': 'O', 'stationCode': {'$in': rtus}}).count()
+        snapshot = self._conditionalUpdateELESIncidents()
+
+        return self.elesIncidentsSnapshot.find(snapshot, {'unitStatus': 'O'}).count()
+
+    def getELESStationSummary(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self._conditionalUpdateELESIncidents()
+
+        snapshotKey = (snapshot['generation'], self.stationsGeneration.current()) if snapshot is not None else None
+        if self.elesSummary[0] == snapshotKey and snapshotKey is not None:
+            return self.elesSummary[1]
+
+        countsByRTU = defaultdict(lambda: defaultdict(int))
+        for incident in self.elesIncidentsSnapshot.find(snapshot, {'unitStatus': 'O'},
+                                                        fields={'stationCode': 1, 'unitType': 1}):
+            countsByRTU[incident['stationCode']][incident['unitType']] += 1
+
+        summary = []
+        for station in self.stationsCollection.find({'rtus': {'$in': countsByRTU.keys()}},
+                                                    sort=[('name', ASCENDING)]):
+            unitTypes = defaultdict(int)
+            for rtu in station['rtus']:
+                for unitType, count in countsByRTU.get(rtu, {}).items():
+                    unitTypes[unitType] += count
+            summary.append({'name': station['name'],
+                            'rtus': station['rtus'],
+                            'lines': station['lines'],
+                            'count': sum(unitTypes.values()),
+                            'unitTypes': dict(unitTypes)})
+
+        self.elesSummary = (snapshotKey, summary)
+        return summary
+
+    def getBusPredictionsTimes(self, stopID):
+        times = self.busPredictionsCollection.find_one({'stopID': stopID},
+                                                      fields={'expiration': 1, 'fetched': 1})
+        return (times['expiration'], times.get('fetched')) if times is not None else (None, None)
+
+    def getBusPredictionsExpiration(self, stopID):
+        return self.getBusPredictionsTimes(stopID)[0]
 
     def getBusPredictions(self, stopID):
-        expiration = self.busPredictionsCollection.find_one({'stopID': stopID},
-                                                           fields={'expiration': '1'})
-        if expiration is None or expiration['expiration'] < datetime.utcnow():
-            self.fetchBusPredictions(stopID)
+        expiration = self.getBusPredictionsExpiration(stopID)
+        self.refresher.revalidate('wmataBusPredictions:' + stopID, expiration,
+                                  freshnessCheck(self.busPredictionsCollection, {'stopID': stopID}),
+                                  lambda: self.fetchBusPredictions(stopID))
 
         return self.busPredictionsCollection.find({'stopID': stopID})
     
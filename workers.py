@@ -0,0 +1,93 @@
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+class RateLimiter(object):
+    """Start at most perSecond calls a second across threads."""
+
+    def __init__(self, perSecond=None):
+        self.interval = 1.0 / perSecond if perSecond else 0
+        self.nextSlot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.nextSlot)
+            self.nextSlot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def parallelMap(func, items, workers=4):
+    """map() on up to workers threads; re-raises the first exception."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+
+    def work():
+        while not errors:
+            try:
+                index, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+class WorkerPool(object):
+    """Daemon threads for fanning calls out from a request."""
+
+    def __init__(self, workers=16):
+        self.queue = Queue()
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            (func, item, index, deadline, results, done) = self.queue.get()
+            if time.time() >= deadline:
+                continue
+            try:
+                outcome = (True, func(item))
+            except Exception:
+                outcome = (False, sys.exc_info()[1])
+            with done:
+                results[index] = outcome
+                done.notify()
+
+    def mapUntil(self, func, items, timeout):
+        """Run func over items for at most timeout seconds; None for unfinished calls."""
+        items = list(items)
+        results = [None] * len(items)
+        done = threading.Condition()
+        deadline = time.time() + timeout
+        for index, item in enumerate(items):
+            self.queue.put((func, item, index, deadline, results, done))
+
+        with done:
+            while None in results:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                done.wait(remaining)
+            return list(results)
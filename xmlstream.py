@@ -0,0 +1,22 @@
+from lxml import etree
+
+def responseChunks(response, chunkSize=16384):
+    return response.iter_content(chunkSize)
+
+def iterElements(chunks, tags=None, events=('end',)):
+    """Yield (event, element) for tags as chunks are parsed; release() each one."""
+    parser = etree.XMLPullParser(events=events, tag=tags)
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event in parser.read_events():
+            yield event
+    parser.close()
+    for event in parser.read_events():
+        yield event
+
+def release(element):
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]